@@ -90,6 +90,7 @@ try:
         handle_reseller_edit_discount,
         handle_reseller_percent_message,
         handle_reseller_delete_discount_confirm,
+        invalidate_reseller_discounts,
     )
 except ImportError:
     logger_dummy_reseller = logging.getLogger(__name__ + "_dummy_reseller")
@@ -111,6 +112,7 @@ except ImportError:
     async def handle_reseller_edit_discount(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None): pass
     async def handle_reseller_percent_message(update: Update, context: ContextTypes.DEFAULT_TYPE): pass
     async def handle_reseller_delete_discount_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None): pass
+    def invalidate_reseller_discounts(user_id: int | None = None): pass
 # ------------------------------------------
 
 
@@ -2058,13 +2060,14 @@ async def handle_confirm_yes(update: Update, context: ContextTypes.DEFAULT_TYPE,
                 reseller_id = int(action_params[0])
                 product_type = action_params[1]
                 # Get old value for logging before deleting
-                c.execute("SELECT discount_percentage FROM reseller_discounts WHERE reseller_user_id = ? AND product_type = ?", (reseller_id, product_type))
+                c.execute("SELECT discount_bp FROM reseller_discounts WHERE reseller_user_id = ? AND product_type = ?", (reseller_id, product_type))
                 old_res = c.fetchone()
-                old_value = old_res['discount_percentage'] if old_res else None
+                old_value = old_res['discount_bp'] / 100 if old_res else None
                 # Delete the rule
                 delete_res_result = c.execute("DELETE FROM reseller_discounts WHERE reseller_user_id = ? AND product_type = ?", (reseller_id, product_type))
                 if delete_res_result.rowcount > 0:
                     conn.commit()
+                    invalidate_reseller_discounts(reseller_id)
                     # Log the action
                     log_admin_action(user_id, ACTION_RESELLER_DISCOUNT_DELETE, reseller_id, reason=f"Type: {product_type}", old_value=old_value)
                     success_msg = f"✅ Reseller discount rule deleted for {product_type}."
@@ -9,6 +9,11 @@ from functools import wraps
 from datetime import timedelta
 import threading # Added for Flask thread
 import json # Added for webhook processing
+try:
+    import orjson # Faster parsing of webhook bodies
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
 from decimal import Decimal, ROUND_DOWN, ROUND_UP # <-- MODIFIED: Import ROUND_DOWN and ROUND_UP
 # *** ADD THESE IMPORTS for webhook verification ***
 import hmac
@@ -43,8 +48,9 @@ from utils import (
     get_db_connection, # Import the DB connection helper
     DATABASE_PATH, # Import DB path if needed for direct error checks (optional)
     get_pending_deposit, remove_pending_deposit, FEE_ADJUSTMENT, # Import deposit/price utils
-    send_message_with_retry, # Import send_message_with_retry
-    log_admin_action # Import admin logging
+    send_message_with_retry, spawn_background_task, # Import send_message_with_retry
+    log_admin_action, flush_admin_log, # Import admin logging
+    MSG_NOT_MODIFIED, get_user_lang
 )
 # <<< Ensure user module is imported >>>
 import user
@@ -414,7 +420,7 @@ async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> N
         error_message = "An internal error occurred. Please try again later or contact support."
         # *** FIXED: Use imported specific error classes ***
         if isinstance(context.error, BadRequest):
-            if "message is not modified" in str(context.error).lower():
+            if MSG_NOT_MODIFIED in context.error.message:
                 logger.debug(f"Ignoring 'message is not modified' error for chat {chat_id}.")
                 return # Don't notify user for this specific error
             logger.warning(f"Telegram API BadRequest for chat {chat_id} (User: {user_id}): {context.error}")
@@ -488,7 +494,6 @@ async def post_init(application: Application) -> None:
 async def post_shutdown(application: Application) -> None:
     """Tasks to run on graceful shutdown."""
     logger.info("Running post_shutdown cleanup...")
-    # No crypto client to close anymore
     logger.info("Post_shutdown finished.")
 
 # Background Job Wrapper for Basket Clearing
@@ -503,6 +508,11 @@ async def clear_expired_baskets_job_wrapper(context: ContextTypes.DEFAULT_TYPE):
         logger.error(f"Error in background job clear_expired_baskets_job: {e}", exc_info=True)
 
 
+# Background Job: keep pooled NOWPayments connections alive
+async def nowpayments_keepalive_job(context: ContextTypes.DEFAULT_TYPE):
+    await payment.warm_nowpayments_client(connections=1)
+
+
 # --- Flask Webhook Routes ---
 
 # *** NEW: Helper function for webhook verification ***
@@ -547,8 +557,15 @@ def nowpayments_webhook():
         logger.warning("Webhook received non-JSON request.")
         return Response("Invalid Request", status=400)
 
-    data = request.get_json()
-    logger.info(f"NOWPayments IPN received (VERIFICATION DISABLED): {json.dumps(data)}") # Log indicates disabled
+    raw_body = request.get_data()
+    try: data = _json_loads(raw_body)
+    except ValueError: # json/orjson JSONDecodeError
+        logger.warning("Webhook received invalid JSON.")
+        return Response("Invalid Request", status=400)
+    if not isinstance(data, dict):
+        logger.warning("Webhook JSON body is not an object.")
+        return Response("Invalid Request", status=400)
+    logger.info(f"NOWPayments IPN received (VERIFICATION DISABLED): {raw_body.decode('utf-8', 'replace')}") # Log the body as received, no re-encode
 
     required_keys = ['payment_id', 'payment_status', 'pay_currency', 'actually_paid']
     if not all(key in data for key in required_keys):
@@ -708,16 +725,9 @@ def nowpayments_webhook():
             is_purchase_failure = pending_info_for_removal.get('is_purchase') == 1
             try:
                 # Get user's language for notification
-                conn_lang = None; user_lang = 'en'
-                try:
-                    conn_lang = get_db_connection()
-                    c_lang = conn_lang.cursor()
-                    c_lang.execute("SELECT language FROM users WHERE user_id = ?", (user_id,))
-                    lang_res = c_lang.fetchone()
-                    if lang_res and lang_res['language'] in LANGUAGES: user_lang = lang_res['language']
+                user_lang = 'en'
+                try: user_lang = get_user_lang(user_id) # Cached; DB only on a miss
                 except Exception as lang_e: logger.error(f"Failed to get lang for user {user_id} notify: {lang_e}")
-                finally:
-                     if conn_lang: conn_lang.close()
 
                 lang_data_local = LANGUAGES.get(user_lang, LANGUAGES['en'])
                 # Send different message for failed purchase vs failed refill
@@ -749,7 +759,7 @@ async def telegram_webhook():
         logger.error("Telegram webhook received but app/loop not ready.")
         return Response(status=503)
     try:
-        update_data = request.get_json(force=True)
+        update_data = _json_loads(request.get_data())
         update = Update.de_json(update_data, telegram_app.bot)
         # Process update in the bot's event loop
         asyncio.run_coroutine_threadsafe(telegram_app.process_update(update), main_loop)
@@ -810,6 +820,14 @@ def main() -> None:
     else:
         logger.warning("BASKET_TIMEOUT is not positive. Skipping background job setup.")
 
+    if application.job_queue:
+        application.job_queue.run_repeating(
+             nowpayments_keepalive_job,
+             interval=timedelta(seconds=payment.NP_KEEPALIVE_INTERVAL_SECONDS),
+             first=timedelta(seconds=payment.NP_KEEPALIVE_INTERVAL_SECONDS),
+             name="nowpayments_keepalive"
+        )
+
     # --- Webhook Setup & Server Start ---
     async def setup_webhooks_and_run():
         nonlocal application
@@ -825,6 +843,7 @@ def main() -> None:
 
         await application.start()
         logger.info("Telegram application started (webhook mode).")
+        spawn_background_task(payment.warm_nowpayments_client()) # Handshake with NOWPayments before the first invoice
 
         port = int(os.environ.get("PORT", 10000)) # Default to 10000 for Render
         flask_thread = threading.Thread(
@@ -847,6 +866,12 @@ def main() -> None:
         logger.critical(f"Critical error in main execution: {e}", exc_info=True)
     finally:
         logger.info("Initiating shutdown...")
+        # post_shutdown only runs under run_polling/run_webhook; this app is started and stopped by hand
+        if main_loop and not main_loop.is_closed():
+            try: main_loop.run_until_complete(flush_admin_log()) # Write admin log rows still waiting for a batch
+            except Exception as e: logger.error(f"Failed to flush admin log on shutdown: {e}", exc_info=True)
+            try: main_loop.run_until_complete(payment.close_nowpayments_client()) # Release pooled NOWPayments connections
+            except Exception as e: logger.error(f"Failed to close NOWPayments client on shutdown: {e}", exc_info=True)
         if telegram_app:
             logger.info("Stopping Telegram application...")
             if main_loop and main_loop.is_running():
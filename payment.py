@@ -6,32 +6,44 @@ import time
 import os # Added import
 import shutil # Added import
 import asyncio
-import uuid # For generating unique order IDs
-import requests # For making API calls to NOWPayments
-from decimal import Decimal, ROUND_UP, ROUND_DOWN # Use Decimal for precision
+import secrets # For generating unique order ID suffixes
+import weakref
+import httpx # Async HTTP client for NOWPayments (ships with python-telegram-bot)
+try:
+    import h2 # noqa: F401 - enables HTTP/2 on the NOWPayments client when installed
+    _NP_HTTP2 = True
+except ImportError:
+    _NP_HTTP2 = False
+from decimal import Decimal, ROUND_UP, ROUND_DOWN, ROUND_HALF_UP, InvalidOperation # Use Decimal for precision
 import json # For parsing potential error messages
+try:
+    import orjson # Faster JSON encoding for NOWPayments request bodies
+except ImportError:
+    orjson = None
 from datetime import datetime, timezone # Added import
-from collections import Counter, defaultdict # Added import
+from collections import ChainMap, Counter, OrderedDict, defaultdict # Added import
+from functools import lru_cache, wraps
 
 # --- Telegram Imports ---
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.constants import ParseMode
 from telegram.ext import ContextTypes
-from telegram import helpers
 import telegram.error as telegram_error
 from telegram import InputMediaPhoto, InputMediaVideo, InputMediaAnimation # Import InputMedia types
 # -------------------------
 
 # Import necessary items from utils and user
 from utils import ( # Ensure utils imports are correct
-    send_message_with_retry, format_currency, ADMIN_ID,
+    send_message_with_retry, tg_call_with_retry, throttle_chat_edit, coalesce_chat_send, MSG_NOT_MODIFIED, escape_markdown_v2, format_currency, ADMIN_ID,
     LANGUAGES, load_all_data, BASKET_TIMEOUT, MIN_DEPOSIT_EUR,
-    NOWPAYMENTS_API_KEY, NOWPAYMENTS_API_URL, WEBHOOK_URL,
+    NOWPAYMENTS_API_KEY, NOWPAYMENTS_API_URL, WEBHOOK_URL, PAYMENT_TRACE_ERRORS,
     format_expiration_time, FEE_ADJUSTMENT,
     add_pending_deposit, remove_pending_deposit, # Make sure add_pending_deposit is imported
-    get_nowpayments_min_amount,
-    get_db_connection, MEDIA_DIR, PRODUCT_TYPES, DEFAULT_PRODUCT_EMOJI, # Added PRODUCT_TYPES/Emoji
-    clear_expired_basket # Added import
+    get_nowpayments_min_amount, lookup_cached_min_amount,
+    set_cached_user_lang,
+    pooled_db_connection, MEDIA_DIR, PRODUCT_TYPES, DEFAULT_PRODUCT_EMOJI, # Added PRODUCT_TYPES/Emoji
+    clear_expired_basket, # Added import
+    clear_payment_ctx, REFILL_CTX_KEYS, BASKET_PAY_CTX_KEYS
 )
 import user # Ensure user module is imported
 
@@ -49,55 +61,215 @@ except ImportError:
 
 logger = logging.getLogger(__name__)
 
+CRYPTO_QUANTUM = Decimal('1E-8') # Smallest crypto unit we bill in (8 decimal places)
+CENT_QUANTUM = Decimal('0.01') # EUR balances are kept in whole cents
+
+def _json_body(payload: dict) -> bytes:
+    """Encodes a request payload to JSON bytes, using orjson when available."""
+    if orjson is not None: return orjson.dumps(payload)
+    return json.dumps(payload, separators=(',', ':')).encode('utf-8')
+
+# --- Static NOWPayments Request Parts (built once at import) ---
+_IPN_CALLBACK_URL = f"{WEBHOOK_URL}/webhook"
+_NP_JSON_HEADERS = {'Content-Type': 'application/json'}
+_PAYLOAD_TEMPLATE = {"ipn_callback_url": _IPN_CALLBACK_URL, "is_fixed_rate": False}
+ORDER_PREFIX_PURCHASE = "PURCHASE"
+ORDER_PREFIX_REFILL = "REFILL"
+_ORDER_KINDS = { # is_purchase -> (order_id prefix, order description label)
+    True: (ORDER_PREFIX_PURCHASE, "Basket purchase"),
+    False: (ORDER_PREFIX_REFILL, "Balance top-up"),
+}
+
+# --- Shared NOWPayments HTTP Client ---
+# One keep-alive pool for every estimate/payment call: no per-request TCP+TLS handshake, no thread hop.
+_np_client = httpx.AsyncClient(
+    base_url=NOWPAYMENTS_API_URL,
+    headers={'x-api-key': NOWPAYMENTS_API_KEY},
+    http2=_NP_HTTP2,
+    limits=httpx.Limits(max_keepalive_connections=20, max_connections=100),
+    timeout=httpx.Timeout(20.0)
+)
+
+NP_WARM_CONNECTIONS = 2 # Idle connections opened ahead of the first user request
+NP_KEEPALIVE_INTERVAL_SECONDS = 60 # Ping often enough that pooled sockets aren't reaped as idle
+
+async def warm_nowpayments_client(connections: int = NP_WARM_CONNECTIONS):
+    """
+    Opens pooled connections to NOWPayments with cheap /v1/status requests, so the TCP+TLS
+    handshake is done before a user selects a currency. Failures are only logged.
+    """
+    results = await asyncio.gather(*(_np_client.get('/v1/status', timeout=10.0) for _ in range(connections)), return_exceptions=True)
+    failures = [r for r in results if isinstance(r, Exception)]
+    if failures: logger.warning(f"NOWPayments warm-up: {len(failures)}/{connections} requests failed: {failures[0]}")
+    else: logger.debug(f"NOWPayments warm-up: {connections} connection(s) ready.")
+
+async def close_nowpayments_client():
+    """Closes the shared NOWPayments client. Called from main()'s shutdown sequence."""
+    await _np_client.aclose()
+
+# --- Helper: Coerce API/Context Values to Decimal ---
+def _as_decimal(value) -> Decimal:
+    """
+    Decimal from a JSON-decoded or stored value. Decimal passes through untouched; int/str are
+    parsed directly; floats go via str so the shortest repr is used, not the binary expansion.
+    Raises InvalidOperation/TypeError for anything else.
+    """
+    if isinstance(value, Decimal): return value
+    if isinstance(value, float): return Decimal(repr(value))
+    if isinstance(value, (int, str)): return Decimal(value)
+    raise TypeError(f"Cannot convert {type(value).__name__} to Decimal")
+
+# --- Helper: Format Crypto Amount ---
+def _fmt_crypto(amount: Decimal) -> str:
+    """Formats a Decimal crypto amount in its minimal plain form (no trailing zeros, no exponent)."""
+    return format(amount.normalize(), 'f')
+
+@lru_cache(maxsize=256)
+def _quantized_min_amount(min_amount: Decimal) -> tuple[Decimal, str]:
+    """
+    NOWPayments minimum rounded up to CRYPTO_QUANTUM (so the invoice never under-bills), plus its
+    display string. Minimums are served from a cache and repeat, so each value is processed once.
+    """
+    min_dec = min_amount.quantize(CRYPTO_QUANTUM, rounding=ROUND_UP)
+    return min_dec, _fmt_crypto(min_dec)
+
+# --- Invoice Handler Strings ---
+# Hardcoded English defaults, consulted only when neither the user's language nor 'en' has the key
+_FALLBACK_STRINGS = {
+    "preparing_invoice": "⏳ Preparing your payment invoice...",
+    "back_profile_button": "Back to Profile",
+    "back_basket_button": "Back to Basket",
+}
+
+@lru_cache(maxsize=len(LANGUAGES) + 1)
+def _invoice_lang_data(lang: str) -> ChainMap:
+    """Chained lookup: user's language -> English -> hardcoded fallbacks. Built once per language; treat as read-only."""
+    return ChainMap(LANGUAGES.get(lang, {}), LANGUAGES['en'], _FALLBACK_STRINGS)
+
+# --- Invoice Creation Error Messages ---
+# Maps create_nowpayments_payment error codes to (LANGUAGES key, English fallback).
+_NOWPAYMENTS_API_ERROR = ("error_nowpayments_api", "❌ Payment API Error: Could not create payment. Please try again later or contact support.")
+_INVOICE_ERROR_MESSAGES = {
+    'estimate_failed': ("error_estimate_failed", "❌ Error: Could not estimate crypto amount. Please try again or select a different currency."),
+    'estimate_currency_not_found': ("error_estimate_currency_not_found", "❌ Error: Currency {currency} not supported for estimation. Please select a different currency."),
+    'min_amount_fetch_error': ("error_min_amount_fetch", "❌ Error: Could not retrieve minimum payment amount for {currency}. Please try again later or select a different currency."),
+    'api_key_invalid': ("error_nowpayments_api_key", "❌ Payment API Error: Invalid API key. Please contact support."),
+    'invalid_api_response': ("error_invalid_nowpayments_response", "❌ Payment API Error: Invalid response received. Please contact support."),
+    'pending_db_error': ("payment_pending_db_error", "❌ Database Error: Could not record pending payment. Please contact support."),
+    'amount_too_low_api': ("payment_amount_too_low_api", "❌ Payment Amount Too Low: The equivalent of {target_eur_amount} EUR in {currency} ({crypto_amount}) is below the minimum required by the payment provider ({min_amount} {currency}). Please try a higher EUR amount."),
+    'amount_below_min': ("payment_amount_too_low_api", "❌ Payment Amount Too Low: The equivalent of {target_eur_amount} EUR in {currency} ({crypto_amount}) is below the minimum required by the payment provider ({min_amount} {currency}). Please try a higher EUR amount."),
+    'api_timeout': _NOWPAYMENTS_API_ERROR,
+    'api_request_failed': _NOWPAYMENTS_API_ERROR,
+    'api_unexpected_error': _NOWPAYMENTS_API_ERROR,
+    'internal_server_error': _NOWPAYMENTS_API_ERROR,
+    'internal_estimate_error': _NOWPAYMENTS_API_ERROR,
+}
+# Basket payments explain a too-low amount in terms of the basket total
+_BASKET_INVOICE_ERROR_MESSAGES = {
+    **_INVOICE_ERROR_MESSAGES,
+    'amount_below_min': ("basket_pay_too_low", "❌ Basket total {basket_total} EUR is below the minimum required for {currency}."),
+}
+_FAILED_INVOICE_CREATION = ("failed_invoice_creation", "❌ Failed to create payment invoice. Please try again later or contact support.")
+
+def _build_invoice_error_text(lang_data: dict, payment_result: dict, selected_asset_code: str, target_eur_amount: Decimal, is_purchase: bool = False) -> str:
+    """Builds the user-facing message for a failed invoice creation. Only called on the error path."""
+    error_messages = _BASKET_INVOICE_ERROR_MESSAGES if is_purchase else _INVOICE_ERROR_MESSAGES
+    lang_key, default_text = error_messages.get(payment_result['error'], _FAILED_INVOICE_CREATION)
+    template = lang_data.get(lang_key, default_text)
+    return template.format(
+        currency=payment_result.get('currency', selected_asset_code.upper()),
+        target_eur_amount=format_currency(payment_result.get('target_eur_amount', target_eur_amount)),
+        crypto_amount=payment_result.get('crypto_amount', 'N/A'),
+        min_amount=payment_result.get('min_amount', 'N/A'),
+        basket_total=payment_result.get('basket_total', 'N/A')
+    )
+
+async def _report_invoice_error(query, context: ContextTypes.DEFAULT_TYPE, lang_data: dict, payment_result: dict, selected_asset_code: str, target_eur_amount: Decimal, back_button_markup: InlineKeyboardMarkup, is_purchase: bool = False):
+    """Shows the invoice creation error in place of the 'preparing' message, falling back to a new message."""
+    error_message_to_user = _build_invoice_error_text(lang_data, payment_result, selected_asset_code, target_eur_amount, is_purchase=is_purchase)
+    try: await query.edit_message_text(error_message_to_user, reply_markup=back_button_markup, parse_mode=None)
+    except Exception as edit_e:
+        logger.error(f"Failed to edit message with {'basket payment' if is_purchase else 'invoice'} creation error: {edit_e}")
+        await send_message_with_retry(context.bot, query.message.chat_id, error_message_to_user, reply_markup=back_button_markup, parse_mode=None)
+
 # --- NEW: Helper to get NOWPayments Estimate ---
+ESTIMATE_CACHE_TTL_SECONDS = 20 # Quotes are stable this long; repeat clicks reuse them
+ESTIMATE_CACHE_MAX = 1024
+_estimate_cache: OrderedDict[tuple[str, str], tuple[dict, float]] = OrderedDict() # (eur amount, currency) -> (estimate, time.monotonic())
+
 async def _get_nowpayments_estimate(target_eur_amount: Decimal, pay_currency_code: str) -> dict:
-    """Gets the estimated crypto amount from NOWPayments API."""
-    if not NOWPAYMENTS_API_KEY:
-        return {'error': 'payment_api_misconfigured'}
+    """
+    Gets the estimated crypto amount from NOWPayments API. pay_currency_code must already be lowercase.
+    NOWPAYMENTS_API_KEY presence is validated once at startup in utils.
+    Successful estimates are cached for ESTIMATE_CACHE_TTL_SECONDS; errors are never cached.
+    """
+    cache_key = (str(target_eur_amount.quantize(CENT_QUANTUM)), pay_currency_code)
+    cached = _estimate_cache.get(cache_key)
+    if cached is not None:
+        if time.monotonic() - cached[1] < ESTIMATE_CACHE_TTL_SECONDS:
+            _estimate_cache.move_to_end(cache_key)
+            return cached[0]
+        del _estimate_cache[cache_key]
 
-    estimate_url = f"{NOWPAYMENTS_API_URL}/v1/estimate"
     params = {
         'amount': float(target_eur_amount),
         'currency_from': 'eur',
-        'currency_to': pay_currency_code.lower()
+        'currency_to': pay_currency_code
     }
-    headers = {'x-api-key': NOWPAYMENTS_API_KEY}
 
     try:
-        def make_estimate_request():
-            try:
-                response = requests.get(estimate_url, params=params, headers=headers, timeout=15)
-                logger.debug(f"NOWPayments estimate response status: {response.status_code}, content: {response.text[:200]}")
-                response.raise_for_status()
-                return response.json()
-            except requests.exceptions.Timeout:
-                logger.error(f"NOWPayments estimate request timed out for {target_eur_amount} EUR to {pay_currency_code}.")
-                return {'error': 'estimate_api_timeout'}
-            except requests.exceptions.RequestException as e:
-                logger.error(f"NOWPayments estimate request error for {target_eur_amount} EUR to {pay_currency_code}: {e}")
-                # Try to parse error message if available
-                error_detail = str(e)
-                if e.response is not None:
-                     error_detail = f"Status {e.response.status_code}: {e.response.text[:200]}"
-                     if "currencies not found" in e.response.text.lower():
-                         return {'error': 'estimate_currency_not_found', 'currency': pay_currency_code.upper()}
-                return {'error': 'estimate_api_request_failed', 'details': error_detail}
-            except Exception as e:
-                 logger.error(f"Unexpected error during NOWPayments estimate call: {e}", exc_info=True)
-                 return {'error': 'estimate_api_unexpected_error', 'details': str(e)}
-
-        estimate_data = await asyncio.to_thread(make_estimate_request)
-
-        # Validate response structure
-        if 'error' not in estimate_data and 'estimated_amount' not in estimate_data:
-             logger.error(f"Invalid estimate response structure: {estimate_data}")
-             return {'error': 'invalid_estimate_response'}
-
-        return estimate_data
-
+        response = await _np_client.get('/v1/estimate', params=params, timeout=15.0)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("NOWPayments estimate response status: %s, content: %r", response.status_code, response.content[:200])
+        response.raise_for_status()
+        estimate_data = json.loads(response.content, parse_float=Decimal) # Decode amounts straight to Decimal
+    except httpx.TimeoutException:
+        logger.error(f"NOWPayments estimate request timed out for {target_eur_amount} EUR to {pay_currency_code}.")
+        return {'error': 'estimate_api_timeout'}
+    except httpx.HTTPStatusError as e:
+        logger.error(f"NOWPayments estimate request error for {target_eur_amount} EUR to {pay_currency_code}: {e}")
+        if b"currencies not found" in e.response.content.lower(): # Bytes compare: no decode on the common path
+            return {'error': 'estimate_currency_not_found', 'currency': pay_currency_code.upper()}
+        return {'error': 'estimate_api_request_failed', 'details': f"Status {e.response.status_code}: {e.response.content[:200].decode('utf-8', 'replace')}"}
+    except httpx.HTTPError as e:
+        logger.error(f"NOWPayments estimate request error for {target_eur_amount} EUR to {pay_currency_code}: {e}")
+        return {'error': 'estimate_api_request_failed', 'details': str(e)}
     except Exception as e:
-        logger.error(f"Unexpected error in _get_nowpayments_estimate: {e}", exc_info=True)
-        return {'error': 'internal_estimate_error', 'details': str(e)}
+        logger.error(f"Unexpected error during NOWPayments estimate call: {e}", exc_info=True)
+        return {'error': 'estimate_api_unexpected_error', 'details': str(e)}
+
+    # Validate response structure
+    if 'error' not in estimate_data and 'estimated_amount' not in estimate_data:
+         logger.error(f"Invalid estimate response structure: {estimate_data}")
+         return {'error': 'invalid_estimate_response'}
+
+    if 'error' not in estimate_data:
+        _estimate_cache[cache_key] = (estimate_data, time.monotonic())
+        if len(_estimate_cache) > ESTIMATE_CACHE_MAX: _estimate_cache.popitem(last=False)
+    return estimate_data
+
+
+# --- Cached Minimum Amount Lookup ---
+_min_amount_locks: defaultdict[str, asyncio.Lock] = defaultdict(asyncio.Lock) # currency -> lock so only one fetch runs per currency
+
+async def _get_min_amount_cached(ccy_lower: str) -> Decimal | None:
+    """
+    Minimum payment amount for ccy_lower, served from utils.min_amount_cache when fresh.
+    On a miss the blocking fetch runs in a worker thread; concurrent callers for the same
+    currency wait for that one fetch instead of issuing their own.
+    """
+    hit, min_amount = lookup_cached_min_amount(ccy_lower)
+    if hit: return min_amount
+    async with _min_amount_locks[ccy_lower]:
+        hit, min_amount = lookup_cached_min_amount(ccy_lower) # Filled while we waited?
+        if hit: return min_amount
+        return await asyncio.to_thread(get_nowpayments_min_amount, ccy_lower)
+
+
+# --- Known Minimums in EUR ---
+MIN_EUR_CACHE_TTL_SECONDS = 900
+MIN_EUR_SHORT_CIRCUIT_MARGIN = Decimal('0.9') # Only short-circuit clearly-too-low amounts; borderline ones get a real estimate
+_min_eur_cache: dict[str, tuple[Decimal, str, float]] = {} # currency -> (minimum in EUR, minimum display string, time.monotonic())
 
 
 # --- Refactored NOWPayments Deposit Creation (Unchanged for reseller logic) ---
@@ -114,135 +286,217 @@ async def create_nowpayments_payment(
     Checks minimum amount. Stores extra info if it's a purchase.
     The target_eur_amount should already account for all discounts.
     """
-    if not NOWPAYMENTS_API_KEY:
-        logger.error("NOWPayments API key is not configured.")
-        return {'error': 'payment_api_misconfigured'}
+    # NOWPAYMENTS_API_KEY presence is validated once at startup in utils (SystemExit if missing)
+
+    # Normalize the currency code once for the whole call
+    ccy_lower = pay_currency_code.lower()
+    ccy_upper = pay_currency_code.upper()
 
     log_type = "direct purchase" if is_purchase else "refill"
     logger.info(f"Attempting to create NOWPayments {log_type} invoice for user {user_id}, {target_eur_amount} EUR via {pay_currency_code}")
 
-    # 1. Get Estimate from NOWPayments
-    estimate_result = await _get_nowpayments_estimate(target_eur_amount, pay_currency_code)
+    # 0. Baskets clearly below the currency's minimum (EUR equivalent from a recent quote) need no API calls
+    if is_purchase:
+        known_min = _min_eur_cache.get(ccy_lower)
+        if known_min is not None and time.monotonic() - known_min[2] < MIN_EUR_CACHE_TTL_SECONDS and target_eur_amount < known_min[0] * MIN_EUR_SHORT_CIRCUIT_MARGIN:
+            logger.warning(f"{log_type.capitalize()} for user {user_id} ({target_eur_amount} EUR) is well below the ~{known_min[0]:.2f} EUR minimum for {pay_currency_code}. Skipping API calls.")
+            return {
+                'error': 'amount_below_min',
+                'currency': ccy_upper,
+                'min_amount': known_min[1],
+                'target_eur_amount': target_eur_amount,
+                'basket_total': format_currency(target_eur_amount)
+            }
+
+    # 1./2. Estimate and minimum amount are independent: fetch them concurrently
+    estimate_result, min_amount_api = await asyncio.gather(
+        _get_nowpayments_estimate(target_eur_amount, ccy_lower),
+        _get_min_amount_cached(ccy_lower)
+    )
 
     if 'error' in estimate_result:
         logger.error(f"Failed to get estimate for {target_eur_amount} EUR to {pay_currency_code}: {estimate_result}")
         if estimate_result['error'] == 'estimate_currency_not_found':
-             return {'error': 'estimate_currency_not_found', 'currency': estimate_result.get('currency', pay_currency_code.upper())}
+             return {'error': 'estimate_currency_not_found', 'currency': estimate_result.get('currency', ccy_upper)}
         return {'error': 'estimate_failed'}
 
-    estimated_crypto_amount = Decimal(str(estimate_result['estimated_amount']))
+    try: estimated_crypto_amount = _as_decimal(estimate_result['estimated_amount']) # Already Decimal/int from JSON decode
+    except (InvalidOperation, TypeError):
+        logger.error(f"Invalid estimated_amount for {target_eur_amount} EUR to {pay_currency_code}: {estimate_result}")
+        return {'error': 'estimate_failed'}
     logger.info(f"NOWPayments estimated {estimated_crypto_amount} {pay_currency_code} needed for {target_eur_amount} EUR")
 
-    # 2. Check Minimum Payment Amount from NOWPayments
-    min_amount_api = get_nowpayments_min_amount(pay_currency_code)
+    # Check Minimum Payment Amount from NOWPayments
     if min_amount_api is None:
         logger.error(f"Could not fetch minimum payment amount for {pay_currency_code} from NOWPayments API.")
-        return {'error': 'min_amount_fetch_error', 'currency': pay_currency_code.upper()}
+        return {'error': 'min_amount_fetch_error', 'currency': ccy_upper}
 
-    invoice_crypto_amount = max(estimated_crypto_amount, min_amount_api)
-    if invoice_crypto_amount > estimated_crypto_amount:
-        logger.warning(f"Estimated amount {estimated_crypto_amount} was below NOWPayments minimum {min_amount_api}. Using minimum for invoice: {invoice_crypto_amount} {pay_currency_code}")
+    min_dec, min_dec_display = _quantized_min_amount(min_amount_api)
+    if estimated_crypto_amount > 0: # Remember the minimum in EUR at this quote's rate
+        _min_eur_cache[ccy_lower] = (min_dec * target_eur_amount / estimated_crypto_amount, min_dec_display, time.monotonic())
 
-    # Check if basket total itself is too low for the *chosen* currency
-    if is_purchase and estimated_crypto_amount < min_amount_api:
-         logger.warning(f"Basket purchase for user {user_id} ({target_eur_amount} EUR -> {estimated_crypto_amount} {pay_currency_code}) is below the API minimum {min_amount_api} {pay_currency_code}.")
+    below_min = estimated_crypto_amount < min_dec
+    # Baskets too low for the *chosen* currency fail fast - no payment POST needed
+    if is_purchase and below_min:
+         logger.warning(f"{log_type.capitalize()} for user {user_id} ({target_eur_amount} EUR -> {estimated_crypto_amount} {pay_currency_code}) is below the API minimum {min_dec} {pay_currency_code}.")
          return {
-             'error': 'basket_pay_too_low',
-             'currency': pay_currency_code.upper(),
-             'min_amount': f"{min_amount_api:.8f}".rstrip('0').rstrip('.'),
+             'error': 'amount_below_min',
+             'currency': ccy_upper,
+             'min_amount': min_dec_display,
+             'crypto_amount': _fmt_crypto(estimated_crypto_amount),
+             'target_eur_amount': target_eur_amount,
              'basket_total': format_currency(target_eur_amount)
          }
+    # Refills below the minimum are invoiced at the (rounded-up) minimum instead
+    invoice_crypto_amount = min_dec if below_min else estimated_crypto_amount
+    if below_min:
+        logger.warning(f"Estimated amount {estimated_crypto_amount} was below NOWPayments minimum {min_dec}. Using minimum for invoice: {invoice_crypto_amount} {pay_currency_code}")
 
     # 3. Prepare API Request Data
-    order_id_prefix = "PURCHASE" if is_purchase else "REFILL"
-    order_id = f"USER{user_id}_{order_id_prefix}_{int(time.time())}_{uuid.uuid4().hex[:6]}"
-    ipn_callback_url = f"{WEBHOOK_URL}/webhook"
-    order_desc = f"Basket purchase for user {user_id}" if is_purchase else f"Balance top-up for user {user_id}"
+    order_id_prefix, order_desc_label = _ORDER_KINDS[is_purchase]
+    # Wall-clock seconds on purpose: the timestamp is read by humans in the NOWPayments dashboard
+    order_id = f"USER{user_id}_{order_id_prefix}_{time.time_ns() // 1_000_000_000}_{secrets.token_hex(3)}"
 
     payload = {
+        **_PAYLOAD_TEMPLATE,
         "price_amount": float(invoice_crypto_amount),
-        "price_currency": pay_currency_code.lower(),
-        "pay_currency": pay_currency_code.lower(),
-        "ipn_callback_url": ipn_callback_url,
+        "price_currency": ccy_lower,
+        "pay_currency": ccy_lower,
         "order_id": order_id,
-        "order_description": f"{order_desc} (~{target_eur_amount:.2f} EUR)",
-        "is_fixed_rate": False,
+        "order_description": f"{order_desc_label} for user {user_id} (~{target_eur_amount:.2f} EUR)",
     }
-    headers = {'x-api-key': NOWPAYMENTS_API_KEY, 'Content-Type': 'application/json'}
-    payment_url = f"{NOWPAYMENTS_API_URL}/v1/payment"
 
     # 4. Make Payment Creation API Call
     try:
-        def make_payment_request():
-            try:
-                response = requests.post(payment_url, headers=headers, json=payload, timeout=20)
-                response.raise_for_status()
-                return response.json()
-            except requests.exceptions.Timeout:
-                 logger.error(f"NOWPayments payment API request timed out for order {order_id}.")
-                 return {'error': 'api_timeout', 'internal': True}
-            except requests.exceptions.RequestException as e:
-                 logger.error(f"NOWPayments payment API request error for order {order_id}: {e}", exc_info=True)
-                 status_code = e.response.status_code if e.response is not None else None
-                 error_content = e.response.text if e.response is not None else "No response content"
-                 if status_code == 401: return {'error': 'api_key_invalid'}
-                 if status_code == 400 and "AMOUNT_MINIMAL_ERROR" in error_content:
-                     logger.warning(f"NOWPayments rejected payment for {order_id} due to amount being too low (API check during payment creation).")
-                     min_amount_fallback = f"{min_amount_api:.8f}".rstrip('0').rstrip('.')
-                     return {'error': 'amount_too_low_api', 'currency': pay_currency_code.upper(), 'min_amount': min_amount_fallback, 'crypto_amount': f"{invoice_crypto_amount:.8f}".rstrip('0').rstrip('.'), 'target_eur_amount': target_eur_amount}
-                 return {'error': 'api_request_failed', 'details': str(e), 'status': status_code, 'content': error_content[:200]}
-            except Exception as e:
-                 logger.error(f"Unexpected error during NOWPayments payment API call for order {order_id}: {e}", exc_info=True)
-                 return {'error': 'api_unexpected_error', 'details': str(e)}
-
-        payment_data = await asyncio.to_thread(make_payment_request)
-        if 'error' in payment_data:
-             if payment_data['error'] == 'api_key_invalid': logger.critical("NOWPayments API Key seems invalid!")
-             elif payment_data.get('internal'): logger.error("Internal error during API request (e.g., timeout).")
-             elif payment_data['error'] == 'amount_too_low_api': return payment_data
-             else: logger.error(f"NOWPayments API returned error during payment creation: {payment_data}")
-             return payment_data # Return other errors as well
-
-        # 5. Validate Payment Response
-        required_keys = ['payment_id', 'pay_address', 'pay_amount', 'pay_currency', 'expiration_estimate_date']
-        if not all(k in payment_data for k in required_keys):
-             logger.error(f"Invalid response from NOWPayments payment API for order {order_id}: Missing keys. Response: {payment_data}")
-             return {'error': 'invalid_api_response'}
-
-        expected_crypto_amount_from_invoice = Decimal(str(payment_data['pay_amount']))
-        payment_data['target_eur_amount_orig'] = float(target_eur_amount) # Store the FINAL EUR amount requested
-        payment_data['pay_amount'] = f"{expected_crypto_amount_from_invoice:.8f}".rstrip('0').rstrip('.')
-        payment_data['is_purchase'] = is_purchase # Pass flag through response for display logic
-
-        # 6. Store Pending Deposit Info
-        add_success = await asyncio.to_thread(
-            add_pending_deposit,
-            payment_data['payment_id'], user_id, payment_data['pay_currency'],
-            float(target_eur_amount), float(expected_crypto_amount_from_invoice),
-            is_purchase=is_purchase,
-            basket_snapshot=basket_snapshot, # Store the snapshot
-            discount_code=discount_code      # Store general discount code used
-        )
-        if not add_success:
-             logger.error(f"Failed to add pending deposit to DB for payment_id {payment_data['payment_id']} (user {user_id}).")
-             return {'error': 'pending_db_error'}
+        response = await _np_client.post('/v1/payment', headers=_NP_JSON_HEADERS, content=_json_body(payload))
+        response.raise_for_status()
+        payment_data = json.loads(response.content, parse_float=Decimal) # Decode amounts straight to Decimal
+    except httpx.TimeoutException:
+        logger.error(f"NOWPayments payment API request timed out for order {order_id}.")
+        payment_data = {'error': 'api_timeout', 'internal': True}
+    except httpx.HTTPStatusError as e:
+        logger.error(f"NOWPayments payment API request error for order {order_id}: {e}", exc_info=PAYMENT_TRACE_ERRORS)
+        status_code = e.response.status_code
+        error_content = e.response.content
+        if status_code == 401: payment_data = {'error': 'api_key_invalid'}
+        elif status_code == 400 and b"AMOUNT_MINIMAL_ERROR" in error_content:
+            logger.warning(f"NOWPayments rejected payment for {order_id} due to amount being too low (API check during payment creation).")
+            payment_data = {'error': 'amount_too_low_api', 'currency': ccy_upper, 'min_amount': min_dec_display, 'crypto_amount': _fmt_crypto(invoice_crypto_amount), 'target_eur_amount': target_eur_amount}
+        else: payment_data = {'error': 'api_request_failed', 'details': str(e), 'status': status_code, 'content': error_content[:200].decode('utf-8', 'replace')}
+    except httpx.HTTPError as e:
+        logger.error(f"NOWPayments payment API request error for order {order_id}: {e}", exc_info=PAYMENT_TRACE_ERRORS)
+        payment_data = {'error': 'api_request_failed', 'details': str(e), 'status': None, 'content': "No response content"}
+    except Exception as e:
+        logger.error(f"Unexpected error during NOWPayments payment API call for order {order_id}: {e}", exc_info=True)
+        payment_data = {'error': 'api_unexpected_error', 'details': str(e)}
+
+    if 'error' in payment_data:
+         if payment_data['error'] == 'api_key_invalid': logger.critical("NOWPayments API Key seems invalid!")
+         elif payment_data.get('internal'): logger.error("Internal error during API request (e.g., timeout).")
+         elif payment_data['error'] == 'amount_too_low_api': return payment_data
+         else: logger.error(f"NOWPayments API returned error during payment creation: {payment_data}")
+         return payment_data # Return other errors as well
+
+    # 5. Validate Payment Response
+    required_keys = ['payment_id', 'pay_address', 'pay_amount', 'pay_currency', 'expiration_estimate_date']
+    if not all(k in payment_data for k in required_keys):
+         logger.error(f"Invalid response from NOWPayments payment API for order {order_id}: Missing keys. Response: {payment_data}")
+         return {'error': 'invalid_api_response'}
+
+    try: expected_crypto_amount_from_invoice = _as_decimal(payment_data['pay_amount'])
+    except (InvalidOperation, TypeError):
+        logger.error(f"Invalid pay_amount from NOWPayments payment API for order {order_id}: {payment_data.get('pay_amount')}")
+        return {'error': 'invalid_api_response'}
+    # 6. Store Pending Deposit Info (in a worker thread, off the event loop)
+    add_success = await asyncio.to_thread(
+        add_pending_deposit,
+        payment_data['payment_id'], user_id, payment_data['pay_currency'],
+        float(target_eur_amount), float(expected_crypto_amount_from_invoice),
+        is_purchase=is_purchase,
+        basket_snapshot=basket_snapshot, # Store the snapshot
+        discount_code=discount_code      # Store general discount code used
+    )
+    if not add_success:
+         logger.error(f"Failed to add pending deposit to DB for payment_id {payment_data['payment_id']} (user {user_id}).")
+         return {'error': 'pending_db_error'}
 
-        logger.info(f"Successfully created NOWPayments {log_type} invoice {payment_data['payment_id']} for user {user_id}.")
-        return payment_data
+    payment_data['target_eur_amount_orig'] = target_eur_amount # Store the FINAL EUR amount requested (Decimal)
+    payment_data['pay_amount_dec'] = expected_crypto_amount_from_invoice # Kept as Decimal for display, no string round-trip
+    payment_data['is_purchase'] = is_purchase # Pass flag through response for display logic
 
-    except Exception as e:
-        logger.error(f"Unexpected error in create_nowpayments_payment for user {user_id}: {e}", exc_info=True)
-        return {'error': 'internal_server_error', 'details': str(e)}
+    logger.info(f"Successfully created NOWPayments {log_type} invoice {payment_data['payment_id']} for user {user_id}.")
+    return payment_data
+
+
+
+# --- Cached Single-Button Keyboards ---
+@lru_cache(maxsize=128)
+def _button_markup(text: str, callback_data: str) -> InlineKeyboardMarkup:
+    """Single-button keyboard. Markups are immutable, so one instance per (text, callback) is shared."""
+    return InlineKeyboardMarkup([[InlineKeyboardButton(text, callback_data=callback_data)]])
+
+def _back_button_markup(label: str, callback_data: str) -> InlineKeyboardMarkup:
+    return _button_markup(f"⬅️ {label}", callback_data)
+
+
+# --- 'Preparing Invoice' Progress Edit ---
+async def _show_preparing_invoice(query, text: str, handler_name: str):
+    """
+    Replaces the crypto-selection message with a progress note. Runs as a task next to
+    invoice creation; failures are logged only, since the invoice edit follows anyway.
+    """
+    try:
+        await query.edit_message_text(text, reply_markup=None, parse_mode=None)
+    except telegram_error.BadRequest as e:
+        if MSG_NOT_MODIFIED not in e.message: logger.warning(f"Couldn't edit message in {handler_name}: {e}")
+        try: await query.answer("Preparing...")
+        except telegram_error.TelegramError as answer_e: logger.debug(f"Couldn't answer callback in {handler_name}: {answer_e}")
+    except telegram_error.TelegramError as e:
+        logger.warning(f"Couldn't show preparing message in {handler_name}: {e}")
+
+
+# --- Double-Click Guard for Invoice Creation ---
+INVOICE_REPEAT_GUARD_SECONDS = 3 # Ignore a second invoice request within this window
+_USER_INVOICE_LOCKS: dict[int, asyncio.Lock] = {}
+
+def _mark_invoice_created(context: ContextTypes.DEFAULT_TYPE):
+    """Starts the repeat-click window; only called once NOWPayments has actually created an invoice."""
+    context.user_data['last_invoice_ts'] = time.monotonic() # time.monotonic(): immune to wall-clock jumps
+
+def invoice_double_click_guard(func):
+    """Lets only one invoice creation run per user and drops repeat clicks shortly after an invoice was created."""
+    @wraps(func)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
+        query = update.callback_query
+        user_id = query.from_user.id
+        running_lock = _USER_INVOICE_LOCKS.get(user_id)
+        if running_lock is not None and running_lock.locked():
+            logger.info(f"Ignoring invoice request from user {user_id} while one is in progress ({func.__name__}).")
+            await query.answer("⏳ Already preparing your invoice...")
+            return
+        last_invoice_ts = context.user_data.get('last_invoice_ts')
+        if last_invoice_ts is not None and 0 <= time.monotonic() - last_invoice_ts < INVOICE_REPEAT_GUARD_SECONDS:
+            logger.info(f"Ignoring repeated invoice request from user {user_id} right after an invoice was created ({func.__name__}).")
+            await query.answer("✅ Your invoice was just created.")
+            return
+        lock = _USER_INVOICE_LOCKS.setdefault(user_id, asyncio.Lock()) # Created only for a request that will run, so it is always popped below
+        try:
+            async with lock:
+                return await func(update, context, params)
+        finally:
+            # Nobody ever waits on this lock (repeat clicks return above), so it is safe to drop
+            if not lock.locked(): _USER_INVOICE_LOCKS.pop(user_id, None)
+    return wrapper
 
 
 # --- Callback Handler for Crypto Selection during Refill ---
+@invoice_double_click_guard
 async def handle_select_refill_crypto(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Handles the user selecting the crypto asset for refill, creates NOWPayments invoice."""
     query = update.callback_query
     user_id = query.from_user.id
-    chat_id = query.message.chat_id
     lang = context.user_data.get("lang", "en") # Get language
-    lang_data = LANGUAGES.get(lang, LANGUAGES['en'])
+    lang_data = _invoice_lang_data(lang)
 
     if not params:
         logger.warning(f"handle_select_refill_crypto called without asset parameter for user {user_id}")
@@ -252,77 +506,51 @@ async def handle_select_refill_crypto(update: Update, context: ContextTypes.DEFA
     selected_asset_code = params[0].lower()
     logger.info(f"User {user_id} selected {selected_asset_code} for refill.")
 
-    refill_eur_amount_float = context.user_data.get('refill_eur_amount')
-    if not refill_eur_amount_float or refill_eur_amount_float <= 0:
+    refill_eur_amount = context.user_data.get('refill_eur_amount') # Stored as Decimal by user.handle_refill_amount_message
+    if not refill_eur_amount or refill_eur_amount <= 0:
         logger.error(f"Refill amount context lost before asset selection for user {user_id}.")
         await query.edit_message_text("❌ Error: Refill amount context lost. Please start the top up again.", parse_mode=None)
-        context.user_data.pop('state', None)
+        clear_payment_ctx(context, REFILL_CTX_KEYS)
         return
 
-    refill_eur_amount_decimal = Decimal(str(refill_eur_amount_float))
-
-    preparing_invoice_msg = lang_data.get("preparing_invoice", "⏳ Preparing your payment invoice...")
-    failed_invoice_creation_msg = lang_data.get("failed_invoice_creation", "❌ Failed to create payment invoice. Please try again later or contact support.")
-    error_nowpayments_api_msg = lang_data.get("error_nowpayments_api", "❌ Payment API Error: Could not create payment. Please try again later or contact support.")
-    error_invalid_response_msg = lang_data.get("error_invalid_nowpayments_response", "❌ Payment API Error: Invalid response received. Please contact support.")
-    error_api_key_msg = lang_data.get("error_nowpayments_api_key", "❌ Payment API Error: Invalid API key. Please contact support.")
-    error_pending_db_msg = lang_data.get("payment_pending_db_error", "❌ Database Error: Could not record pending payment. Please contact support.")
-    error_amount_too_low_api_msg = lang_data.get("payment_amount_too_low_api", "❌ Payment Amount Too Low: The equivalent of {target_eur_amount} EUR in {currency} ({crypto_amount}) is below the minimum required by the payment provider ({min_amount} {currency}). Please try a higher EUR amount.")
-    error_min_amount_fetch_msg = lang_data.get("error_min_amount_fetch", "❌ Error: Could not retrieve minimum payment amount for {currency}. Please try again later or select a different currency.")
-    error_estimate_failed_msg = lang_data.get("error_estimate_failed", "❌ Error: Could not estimate crypto amount. Please try again or select a different currency.")
-    error_estimate_currency_not_found_msg = lang_data.get("error_estimate_currency_not_found", "❌ Error: Currency {currency} not supported for estimation. Please select a different currency.")
-    back_to_profile_button = lang_data.get("back_profile_button", "Back to Profile")
-    back_button_markup = InlineKeyboardMarkup([[InlineKeyboardButton(f"⬅️ {back_to_profile_button}", callback_data="profile")]])
+    refill_eur_amount_decimal = Decimal(refill_eur_amount)
 
-    try:
-        await query.edit_message_text(preparing_invoice_msg, reply_markup=None, parse_mode=None)
-    except telegram_error.BadRequest as e:
-        if "message is not modified" not in str(e).lower(): logger.warning(f"Couldn't edit message in handle_select_refill_crypto: {e}")
-        await query.answer("Preparing...")
+    preparing_invoice_msg = lang_data["preparing_invoice"]
+    back_to_profile_button = lang_data["back_profile_button"]
+    back_button_markup = _back_button_markup(back_to_profile_button, "profile")
 
-    # Call payment creation - specify it's NOT a purchase
-    payment_result = await create_nowpayments_payment(
-        user_id, refill_eur_amount_decimal, selected_asset_code,
-        is_purchase=False # Explicitly False for refill
-    )
+    # The 'preparing' edit goes out while the invoice is being created, not before it
+    preparing_task = asyncio.create_task(_show_preparing_invoice(query, preparing_invoice_msg, "handle_select_refill_crypto"))
+
+    # Call payment creation - specify it's NOT a purchase. Refill context is cleared exactly once, whatever the outcome.
+    try:
+        payment_result = await create_nowpayments_payment(
+            user_id, refill_eur_amount_decimal, selected_asset_code,
+            is_purchase=False # Explicitly False for refill
+        )
+    finally:
+        clear_payment_ctx(context, REFILL_CTX_KEYS)
+        await preparing_task # Result/error edits must land after the 'preparing' edit
 
     if 'error' in payment_result:
         error_code = payment_result['error']
         logger.error(f"Failed to create NOWPayments refill invoice for user {user_id}: {error_code} - Details: {payment_result}")
 
-        error_message_to_user = failed_invoice_creation_msg # Default error
-        if error_code == 'estimate_failed': error_message_to_user = error_estimate_failed_msg
-        elif error_code == 'estimate_currency_not_found': error_message_to_user = error_estimate_currency_not_found_msg.format(currency=payment_result.get('currency', selected_asset_code.upper()))
-        elif error_code == 'min_amount_fetch_error': error_message_to_user = error_min_amount_fetch_msg.format(currency=payment_result.get('currency', selected_asset_code.upper()))
-        elif error_code == 'api_key_invalid': error_message_to_user = error_api_key_msg
-        elif error_code == 'invalid_api_response': error_message_to_user = error_invalid_response_msg
-        elif error_code == 'pending_db_error': error_message_to_user = error_pending_db_msg
-        elif error_code == 'amount_too_low_api': # Should ideally not happen for refill unless min deposit is very high
-             min_amount_val = payment_result.get('min_amount', 'N/A'); crypto_amount_val = payment_result.get('crypto_amount', 'N/A')
-             target_eur_val = payment_result.get('target_eur_amount', refill_eur_amount_decimal)
-             error_message_to_user = error_amount_too_low_api_msg.format(target_eur_amount=format_currency(target_eur_val), currency=payment_result.get('currency', selected_asset_code.upper()), crypto_amount=crypto_amount_val, min_amount=min_amount_val)
-        elif error_code in ['api_timeout', 'api_request_failed', 'api_unexpected_error', 'internal_server_error', 'internal_estimate_error']:
-            error_message_to_user = error_nowpayments_api_msg
-
-        try: await query.edit_message_text(error_message_to_user, reply_markup=back_button_markup, parse_mode=None)
-        except Exception as edit_e: logger.error(f"Failed to edit message with invoice creation error: {edit_e}"); await send_message_with_retry(context.bot, chat_id, error_message_to_user, reply_markup=back_button_markup, parse_mode=None)
-        context.user_data.pop('refill_eur_amount', None)
-        context.user_data.pop('state', None) # Reset state on error
+        await _report_invoice_error(query, context, lang_data, payment_result, selected_asset_code, refill_eur_amount_decimal, back_button_markup)
     else:
         logger.info(f"NOWPayments refill invoice created successfully for user {user_id}. Payment ID: {payment_result.get('payment_id')}")
-        context.user_data.pop('refill_eur_amount', None)
-        context.user_data.pop('state', None)
+        _mark_invoice_created(context)
         await display_nowpayments_invoice(update, context, payment_result)
 
 
 # --- NEW: Callback Handler for Crypto Selection during Basket Payment ---
+@invoice_double_click_guard
 async def handle_select_basket_crypto(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Handles the user selecting crypto asset for direct basket payment."""
     query = update.callback_query
     user_id = query.from_user.id
-    chat_id = query.message.chat_id
     lang = context.user_data.get("lang", "en")
-    lang_data = LANGUAGES.get(lang, LANGUAGES['en'])
+    lang_data = _invoice_lang_data(lang)
 
     if not params:
         logger.warning(f"handle_select_basket_crypto called without asset parameter for user {user_id}")
@@ -340,77 +568,38 @@ async def handle_select_basket_crypto(update: Update, context: ContextTypes.DEFA
     if basket_snapshot is None or final_total_eur_float is None:
         logger.error(f"Basket payment context lost before crypto selection for user {user_id}.")
         await query.edit_message_text("❌ Error: Payment context lost. Please go back to your basket.",
-                                       reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ View Basket", callback_data="view_basket")]]) ,parse_mode=None)
-        context.user_data.pop('state', None)
-        # Clear potentially stale basket payment context
-        context.user_data.pop('basket_pay_snapshot', None)
-        context.user_data.pop('basket_pay_total_eur', None)
-        context.user_data.pop('basket_pay_discount_code', None)
+                                       reply_markup=_back_button_markup("View Basket", "view_basket"), parse_mode=None)
+        clear_payment_ctx(context, BASKET_PAY_CTX_KEYS) # Clear potentially stale basket payment context
         return
 
-    final_total_eur_decimal = Decimal(str(final_total_eur_float))
+    final_total_eur_decimal = _as_decimal(final_total_eur_float)
 
     # Get language strings (same as refill for now, potentially customize later)
-    preparing_invoice_msg = lang_data.get("preparing_invoice", "⏳ Preparing your payment invoice...")
-    failed_invoice_creation_msg = lang_data.get("failed_invoice_creation", "❌ Failed to create payment invoice. Please try again later or contact support.")
-    error_nowpayments_api_msg = lang_data.get("error_nowpayments_api", "❌ Payment API Error: Could not create payment. Please try again later or contact support.")
-    error_invalid_response_msg = lang_data.get("error_invalid_nowpayments_response", "❌ Payment API Error: Invalid response received. Please contact support.")
-    error_api_key_msg = lang_data.get("error_nowpayments_api_key", "❌ Payment API Error: Invalid API key. Please contact support.")
-    error_pending_db_msg = lang_data.get("payment_pending_db_error", "❌ Database Error: Could not record pending payment. Please contact support.")
-    error_amount_too_low_api_msg = lang_data.get("payment_amount_too_low_api", "❌ Payment Amount Too Low: The equivalent of {target_eur_amount} EUR in {currency} ({crypto_amount}) is below the minimum required by the payment provider ({min_amount} {currency}). Please try a higher EUR amount.")
-    error_min_amount_fetch_msg = lang_data.get("error_min_amount_fetch", "❌ Error: Could not retrieve minimum payment amount for {currency}. Please try again later or select a different currency.")
-    error_estimate_failed_msg = lang_data.get("error_estimate_failed", "❌ Error: Could not estimate crypto amount. Please try again or select a different currency.")
-    error_estimate_currency_not_found_msg = lang_data.get("error_estimate_currency_not_found", "❌ Error: Currency {currency} not supported for estimation. Please select a different currency.")
-    error_basket_pay_too_low_msg = lang_data.get("basket_pay_too_low", "❌ Basket total {basket_total} EUR is below the minimum required for {currency}.") # <<< Specific error message
-    back_to_basket_button = lang_data.get("back_basket_button", "Back to Basket")
-    back_button_markup = InlineKeyboardMarkup([[InlineKeyboardButton(f"⬅️ {back_to_basket_button}", callback_data="view_basket")]])
+    preparing_invoice_msg = lang_data["preparing_invoice"]
+    back_to_basket_button = lang_data["back_basket_button"]
+    back_button_markup = _back_button_markup(back_to_basket_button, "view_basket")
 
-    try:
-        await query.edit_message_text(preparing_invoice_msg, reply_markup=None, parse_mode=None)
-    except telegram_error.BadRequest as e:
-        if "message is not modified" not in str(e).lower(): logger.warning(f"Couldn't edit message in handle_select_basket_crypto: {e}")
-        await query.answer("Preparing...")
+    # The 'preparing' edit goes out while the invoice is being created, not before it
+    preparing_task = asyncio.create_task(_show_preparing_invoice(query, preparing_invoice_msg, "handle_select_basket_crypto"))
 
     # Call payment creation - specify it IS a purchase, pass FINAL total
-    payment_result = await create_nowpayments_payment(
-        user_id, final_total_eur_decimal, selected_asset_code, # Pass final total
-        is_purchase=True,
-        basket_snapshot=basket_snapshot,
-        discount_code=discount_code_used
-    )
-
-    # Clear context *after* attempting payment creation
-    context.user_data.pop('basket_pay_snapshot', None)
-    context.user_data.pop('basket_pay_total_eur', None)
-    context.user_data.pop('basket_pay_discount_code', None)
-    context.user_data.pop('state', None) # Ensure state is cleared
+    try:
+        payment_result = await create_nowpayments_payment(
+            user_id, final_total_eur_decimal, selected_asset_code, # Pass final total
+            is_purchase=True,
+            basket_snapshot=basket_snapshot,
+            discount_code=discount_code_used
+        )
+    finally:
+        # Clear context *after* attempting payment creation, even if it raised
+        clear_payment_ctx(context, BASKET_PAY_CTX_KEYS)
+        await preparing_task # Result/error edits must land after the 'preparing' edit
 
     if 'error' in payment_result:
         error_code = payment_result['error']
         logger.error(f"Failed to create NOWPayments basket payment invoice for user {user_id}: {error_code} - Details: {payment_result}")
 
-        error_message_to_user = failed_invoice_creation_msg # Default error
-        # Handle specific errors
-        if error_code == 'basket_pay_too_low': # Handle the new specific error
-            error_message_to_user = error_basket_pay_too_low_msg.format(
-                basket_total=payment_result.get('basket_total', 'N/A'),
-                currency=payment_result.get('currency', selected_asset_code.upper())
-            )
-        elif error_code == 'estimate_failed': error_message_to_user = error_estimate_failed_msg
-        elif error_code == 'estimate_currency_not_found': error_message_to_user = error_estimate_currency_not_found_msg.format(currency=payment_result.get('currency', selected_asset_code.upper()))
-        elif error_code == 'min_amount_fetch_error': error_message_to_user = error_min_amount_fetch_msg.format(currency=payment_result.get('currency', selected_asset_code.upper()))
-        elif error_code == 'api_key_invalid': error_message_to_user = error_api_key_msg
-        elif error_code == 'invalid_api_response': error_message_to_user = error_invalid_response_msg
-        elif error_code == 'pending_db_error': error_message_to_user = error_pending_db_msg
-        elif error_code == 'amount_too_low_api': # Should ideally not happen due to pre-check, but handle anyway
-             min_amount_val = payment_result.get('min_amount', 'N/A'); crypto_amount_val = payment_result.get('crypto_amount', 'N/A')
-             target_eur_val = payment_result.get('target_eur_amount', final_total_eur_decimal)
-             error_message_to_user = error_amount_too_low_api_msg.format(target_eur_amount=format_currency(target_eur_val), currency=payment_result.get('currency', selected_asset_code.upper()), crypto_amount=crypto_amount_val, min_amount=min_amount_val)
-        elif error_code in ['api_timeout', 'api_request_failed', 'api_unexpected_error', 'internal_server_error', 'internal_estimate_error']:
-            error_message_to_user = error_nowpayments_api_msg
-
-        try: await query.edit_message_text(error_message_to_user, reply_markup=back_button_markup, parse_mode=None)
-        except Exception as edit_e: logger.error(f"Failed to edit message with basket payment creation error: {edit_e}"); await send_message_with_retry(context.bot, chat_id, error_message_to_user, reply_markup=back_button_markup, parse_mode=None)
+        await _report_invoice_error(query, context, lang_data, payment_result, selected_asset_code, final_total_eur_decimal, back_button_markup, is_purchase=True)
 
         # Since payment failed, the items are still reserved in the user's main basket.
         # Send them back to the basket view.
@@ -418,190 +607,307 @@ async def handle_select_basket_crypto(update: Update, context: ContextTypes.DEFA
 
     else:
         logger.info(f"NOWPayments basket payment invoice created successfully for user {user_id}. Payment ID: {payment_result.get('payment_id')}")
+        _mark_invoice_created(context)
         # Display the invoice (same function as refill)
         await display_nowpayments_invoice(update, context, payment_result)
         # Important: DO NOT clear the user's actual basket here.
         # It only gets cleared after the webhook confirms payment.
 
+# --- Invoice Message Templates (built once per language/type) ---
+def _template_literal(text: str) -> str:
+    """Escapes braces in static language text so it survives str.format_map."""
+    return text.replace('{', '{{').replace('}', '}}')
+
+@lru_cache(maxsize=len(LANGUAGES) * 2)
+def _invoice_template(user_lang: str, is_purchase: bool) -> tuple[str, InlineKeyboardMarkup]:
+    """
+    Builds the invoice message skeleton for a language and invoice type.
+    Returns (skeleton, back_button_markup). The skeleton has format_map
+    placeholders for the dynamic, already-escaped fields: target_eur, pay_amount,
+    currency, address and expiry. Language labels are already MarkdownV2-escaped.
+    """
+    lang_data = LANGUAGES.get(user_lang, LANGUAGES['en'])
+    if is_purchase:
+        title = lang_data.get("invoice_title_purchase", "*Payment Invoice Created*")
+        send_warning_template = lang_data.get("send_warning_template", "⚠️ *Important:* Send *exactly* this amount of {asset} to this address\\.")
+        note = _template_literal(send_warning_template).replace('{{asset}}', '{currency}')
+        back_button_text = lang_data.get("back_basket_button", "Back to Basket")
+        back_callback = "view_basket"
+    else: # It's a refill
+        title = lang_data.get("invoice_title_refill", "*Top\\-Up Invoice Created*")
+        note = _template_literal(lang_data.get("overpayment_note", "ℹ️ _Sending more than this amount is okay\\! Your balance will be credited based on the amount received after network confirmation\\._"))
+        back_button_text = lang_data.get("back_profile_button", "Back to Profile")
+        back_callback = "profile"
+    amount_label = _template_literal(lang_data.get("amount_label", "*Amount:*"))
+    payment_address_label = _template_literal(lang_data.get("payment_address_label", "*Payment Address:*"))
+    expires_at_label = _template_literal(lang_data.get("expires_at_label", "*Expires At:*"))
+    confirmation_note = _template_literal(lang_data.get("confirmation_note", "✅ Confirmation is automatic via webhook after network confirmation\\."))
+
+    parts = [
+        _template_literal(title), "",
+        "_\\(Amount: {target_eur} EUR\\)_", "", # Static wrapper pre-escaped; only the amount is escaped per render
+        "Please send the following amount:",
+        f"{amount_label} `{{pay_amount}}` {{currency}}", "",
+        payment_address_label,
+        "`{address}`", "",
+        f"{expires_at_label} {{expiry}}", "",
+        note, "",
+        confirmation_note,
+    ]
+    skeleton = "\n".join(parts).strip()
+    return skeleton, _back_button_markup(back_button_text, back_callback)
+
+# Currency codes come from a small fixed set, so their escaped form is memoized (addresses are per-payment, not cached)
+_escape_currency = lru_cache(maxsize=64)(escape_markdown_v2)
+
+# Build every language's skeletons at import so no user pays for the first render
+for _lang in LANGUAGES:
+    _invoice_template(_lang, True); _invoice_template(_lang, False)
+
+
 # --- Display NOWPayments Invoice ---
+async def _show_invoice_display_error(query, chat_id: int, error_display_msg: str, back_button_markup: InlineKeyboardMarkup):
+    """Replaces the invoice message with an error; a failed edit is only logged."""
+    try: await tg_call_with_retry(lambda: query.edit_message_text(error_display_msg, reply_markup=back_button_markup, parse_mode=None), chat_id=chat_id)
+    except telegram_error.TelegramError as edit_e: logger.debug(f"Could not show invoice error message in chat {chat_id}: {edit_e}") # Incl. Forbidden, exhausted RetryAfter/NetworkError
+
 async def display_nowpayments_invoice(update: Update, context: ContextTypes.DEFAULT_TYPE, payment_data: dict):
     """Displays the NOWPayments invoice details with improved formatting."""
     query = update.callback_query
     chat_id = query.message.chat_id
     lang = context.user_data.get("lang", "en")
-    lang_data = LANGUAGES.get(lang, LANGUAGES['en'])
+    if lang not in LANGUAGES: lang = 'en'
+    lang_data = _invoice_lang_data(lang) # Same per-language chained lookup as the invoice handlers
     final_msg = "Error displaying invoice."
     is_purchase_invoice = payment_data.get('is_purchase', False) # Check if it's a purchase
+    skeleton, back_button_markup = _invoice_template(lang, is_purchase_invoice) # Back button is shared by success and error paths
 
     try:
         pay_address = payment_data.get('pay_address')
-        pay_amount_str = payment_data.get('pay_amount')
+        pay_amount_decimal = payment_data.get('pay_amount_dec')
         pay_currency = payment_data.get('pay_currency', 'N/A').upper()
         payment_id = payment_data.get('payment_id', 'N/A')
         target_eur_orig = payment_data.get('target_eur_amount_orig') # Final EUR amount requested
         expiration_date_str = payment_data.get('expiration_estimate_date')
 
-        if not pay_address or not pay_amount_str:
+        if not pay_address or pay_amount_decimal is None:
             logger.error(f"Missing critical data in NOWPayments response for display: {payment_data}")
             raise ValueError("Missing payment address or amount")
 
-        pay_amount_decimal = Decimal(pay_amount_str)
-        pay_amount_display = '{:f}'.format(pay_amount_decimal.normalize())
-        target_eur_display = format_currency(Decimal(str(target_eur_orig))) if target_eur_orig else "N/A"
+        pay_amount_display = _fmt_crypto(pay_amount_decimal)
+        target_eur_display = format_currency(target_eur_orig) if target_eur_orig else "N/A"
         expiry_time_display = format_expiration_time(expiration_date_str)
 
+        # Only the dynamic fields need escaping; the skeleton is pre-built per language
+        final_msg = skeleton.format_map({
+            'target_eur': escape_markdown_v2(target_eur_display),
+            'pay_amount': escape_markdown_v2(pay_amount_display),
+            'currency': _escape_currency(pay_currency),
+            'address': escape_markdown_v2(pay_address),
+            'expiry': escape_markdown_v2(expiry_time_display),
+        })
+
+        await tg_call_with_retry(lambda: query.edit_message_text(
+            final_msg, reply_markup=back_button_markup,
+            parse_mode=ParseMode.MARKDOWN_V2, disable_web_page_preview=True
+        ), chat_id=chat_id) # Paced per chat: rapid invoice refreshes can't pile up 429s (the 'preparing' edit reserves no slot)
+    except (ValueError, KeyError, TypeError) as e: # Bad/missing invoice data - message says it all, no traceback
+        logger.error(f"Error formatting or displaying NOWPayments invoice: {e}. Data: {payment_data}")
+        await _show_invoice_display_error(query, chat_id, lang_data.get("error_preparing_payment", "❌ An error occurred while preparing the payment details. Please try again later."), back_button_markup)
+    except telegram_error.BadRequest as e: # 'message is not modified' is already absorbed by tg_call_with_retry
+        logger.error(f"Error editing NOWPayments invoice message: {e}. Attempted message: {final_msg}")
+    except telegram_error.NetworkError as e: # Retries exhausted in tg_call_with_retry
+        logger.warning(f"Network error editing NOWPayments invoice message in chat {chat_id}: {e}")
+    except Exception as e:
+         logger.error(f"Unexpected error in display_nowpayments_invoice: {e}", exc_info=True)
+         await _show_invoice_display_error(query, chat_id, lang_data.get("error_preparing_payment", "❌ An unexpected error occurred while preparing the payment details."), back_button_markup)
 
-        invoice_title_template = lang_data.get("invoice_title_purchase", "*Payment Invoice Created*") if is_purchase_invoice else lang_data.get("invoice_title_refill", "*Top\\-Up Invoice Created*")
-        amount_label = lang_data.get("amount_label", "*Amount:*")
-        payment_address_label = lang_data.get("payment_address_label", "*Payment Address:*")
-        expires_at_label = lang_data.get("expires_at_label", "*Expires At:*")
-        send_warning_template = lang_data.get("send_warning_template", "⚠️ *Important:* Send *exactly* this amount of {asset} to this address\\.")
-        confirmation_note = lang_data.get("confirmation_note", "✅ Confirmation is automatic via webhook after network confirmation\\.")
-        overpayment_note = lang_data.get("overpayment_note", "ℹ️ _Sending more than this amount is okay\\! Your balance will be credited based on the amount received after network confirmation\\._") # Only for refill
-        back_to_profile_button = lang_data.get("back_profile_button", "Back to Profile")
-        back_to_basket_button = lang_data.get("back_basket_button", "Back to Basket")
-
-        escaped_target_eur = helpers.escape_markdown(target_eur_display, version=2)
-        escaped_pay_amount = helpers.escape_markdown(pay_amount_display, version=2)
-        escaped_currency = helpers.escape_markdown(pay_currency, version=2)
-        escaped_address = helpers.escape_markdown(pay_address, version=2)
-        escaped_expiry = helpers.escape_markdown(expiry_time_display, version=2)
 
-        msg = f"""{invoice_title_template}
+# --- Process Successful Refill ---
+# user_id -> lock serializing that user's refills. Weak values: an entry disappears once no refill holds or
+# awaits its lock, so the map doesn't grow with every user ever refilled (and a waiter never sees it swapped)
+_refill_locks: weakref.WeakValueDictionary[int, asyncio.Lock] = weakref.WeakValueDictionary()
 
-_{helpers.escape_markdown(f"(Amount: {target_eur_display} EUR)", version=2)}_
+def _refill_lock(user_id: int) -> asyncio.Lock:
+    lock = _refill_locks.get(user_id)
+    if lock is None: lock = _refill_locks[user_id] = asyncio.Lock()
+    return lock
+RECENT_PAYMENT_IDS_MAX = 4096
+_recent_payment_ids: OrderedDict[str, None] = OrderedDict() # LRU of credited payment_ids; processed_payments stays the durable record
 
-Please send the following amount:
-{amount_label} `{escaped_pay_amount}` {escaped_currency}
+_pending_refill_added: dict[int, Decimal] = {} # user_id -> credited amount awaiting the coalesced notification
 
-{payment_address_label}
-`{escaped_address}`
+def _is_recent_payment(payment_id: str) -> bool:
+    if payment_id in _recent_payment_ids:
+        _recent_payment_ids.move_to_end(payment_id)
+        return True
+    return False
 
-{expires_at_label} {escaped_expiry}
+def _remember_payment(payment_id: str) -> None:
+    _recent_payment_ids[payment_id] = None
+    _recent_payment_ids.move_to_end(payment_id)
+    if len(_recent_payment_ids) > RECENT_PAYMENT_IDS_MAX:
+        _recent_payment_ids.popitem(last=False)
 
-"""
-        # Add relevant notes based on type
-        if is_purchase_invoice:
-            msg += f"{send_warning_template.format(asset=escaped_currency)}\n"
-        else: # It's a refill
-            msg += f"{overpayment_note}\n"
+def _do_refill_txn(user_id: int, amount_float: float, payment_id: str) -> tuple[str, str, Decimal | None]:
+    """
+    Synchronous refill transaction, run via asyncio.to_thread so the event loop isn't blocked.
+    Returns (status, user_lang, new_balance) where status is 'credited', 'duplicate' or 'user_not_found'.
+    Raises sqlite3.Error on DB failure.
+    """
+    user_lang = 'en' # Only the 'credited' path needs the real language; it comes back with the balance
+    with pooled_db_connection() as conn:
+        c = conn.cursor()
+        c.execute("BEGIN")
+        # Durable idempotency: a payment_id is only ever credited once
+        claim_result = c.execute("INSERT OR IGNORE INTO processed_payments (payment_id, processed_at) VALUES (?, ?)", (payment_id, datetime.now(timezone.utc).isoformat()))
+        if claim_result.rowcount == 0: return 'duplicate', user_lang, None # Pool rolls back on return
 
-        msg += f"\n{confirmation_note}"
+        logger.info("Attempting balance update for user %s by %.2f EUR (Refill Payment ID: %s)", user_id, amount_float, payment_id)
 
-        final_msg = msg.strip()
-        # Determine correct back button
-        back_button_text = back_to_basket_button if is_purchase_invoice else back_to_profile_button
-        back_callback = "view_basket" if is_purchase_invoice else "profile"
-        keyboard = [[InlineKeyboardButton(f"⬅️ {back_button_text}", callback_data=back_callback)]]
+        # Single statement: update and read back the new balance and the user's language (SQLite >= 3.35).
+        # ROUND(..., 2) keeps the stored value on a cent boundary so float drift can't accumulate.
+        new_balance_result = c.execute("UPDATE users SET balance = ROUND(balance + ?, 2) WHERE user_id = ? RETURNING balance, language", (amount_float, user_id)).fetchone()
+        if new_balance_result is None: return 'user_not_found', user_lang, None # Pool rolls back on return
 
-        await query.edit_message_text(
-            final_msg, reply_markup=InlineKeyboardMarkup(keyboard),
-            parse_mode=ParseMode.MARKDOWN_V2, disable_web_page_preview=True
-        )
-    except (ValueError, KeyError, TypeError) as e:
-        logger.error(f"Error formatting or displaying NOWPayments invoice: {e}. Data: {payment_data}", exc_info=True)
-        error_display_msg = lang_data.get("error_preparing_payment", "❌ An error occurred while preparing the payment details. Please try again later.")
-        # Determine correct back button on error too
-        back_button_text = back_to_basket_button if is_purchase_invoice else back_to_profile_button
-        back_callback = "view_basket" if is_purchase_invoice else "profile"
-        back_button_markup = InlineKeyboardMarkup([[InlineKeyboardButton(f"⬅️ {back_button_text}", callback_data=back_callback)]])
-        try: await query.edit_message_text(error_display_msg, reply_markup=back_button_markup, parse_mode=None)
-        except Exception: pass
-    except telegram_error.BadRequest as e:
-        if "message is not modified" not in str(e).lower():
-             logger.error(f"Error editing NOWPayments invoice message: {e}. Attempted message (unescaped for logging): {msg.strip()}")
-        else: await query.answer()
-    except Exception as e:
-         logger.error(f"Unexpected error in display_nowpayments_invoice: {e}", exc_info=True)
-         error_display_msg = lang_data.get("error_preparing_payment", "❌ An unexpected error occurred while preparing the payment details.")
-         back_button_text = back_to_basket_button if is_purchase_invoice else back_to_profile_button
-         back_callback = "view_basket" if is_purchase_invoice else "profile"
-         back_button_markup = InlineKeyboardMarkup([[InlineKeyboardButton(f"⬅️ {back_button_text}", callback_data=back_callback)]])
-         try: await query.edit_message_text(error_display_msg, reply_markup=back_button_markup, parse_mode=None)
-         except Exception: pass
+        conn.commit()
+        user_lang = new_balance_result['language'] if new_balance_result['language'] in LANGUAGES else 'en'
+        return 'credited', user_lang, Decimal(str(new_balance_result['balance'])).quantize(CENT_QUANTUM)
 
 
-# --- Process Successful Refill (Unchanged) ---
 async def process_successful_refill(user_id: int, amount_to_add_eur: Decimal, payment_id: str, context: ContextTypes.DEFAULT_TYPE) -> bool:
     bot = context.bot
-    user_lang = 'en'
-    conn_lang = None
-    try:
-        conn_lang = get_db_connection()
-        c_lang = conn_lang.cursor()
-        c_lang.execute("SELECT language FROM users WHERE user_id = ?", (user_id,))
-        lang_res = c_lang.fetchone()
-        if lang_res and lang_res['language'] in LANGUAGES:
-            user_lang = lang_res['language']
-    except sqlite3.Error as e:
-        logger.error(f"DB error fetching language for user {user_id} during refill confirmation: {e}")
-    finally:
-        if conn_lang: conn_lang.close()
 
-    lang_data = LANGUAGES.get(user_lang, LANGUAGES['en'])
+    # Duplicate IPN for a payment we credited recently: done, no DB round-trip needed
+    if _is_recent_payment(payment_id):
+        logger.info(f"Refill payment {payment_id} for user {user_id} already credited (cached). Skipping duplicate.")
+        return True
 
     if not isinstance(amount_to_add_eur, Decimal) or amount_to_add_eur <= Decimal('0.0'):
         logger.error(f"Invalid amount_to_add_eur in process_successful_refill: {amount_to_add_eur}")
         return False
 
-    conn = None
-    db_update_successful = False
+    # Balances are stored in whole cents: round the credit in Decimal before it touches the REAL column
+    amount_to_add_eur = amount_to_add_eur.quantize(CENT_QUANTUM, rounding=ROUND_HALF_UP)
     amount_float = float(amount_to_add_eur)
-    new_balance = Decimal('0.0')
-
-    try:
-        conn = get_db_connection()
-        c = conn.cursor()
-        c.execute("BEGIN")
-        logger.info(f"Attempting balance update for user {user_id} by {amount_float:.2f} EUR (Refill Payment ID: {payment_id})")
 
-        update_result = c.execute("UPDATE users SET balance = balance + ? WHERE user_id = ?", (amount_float, user_id))
-        if update_result.rowcount == 0:
-            logger.error(f"User {user_id} not found during refill DB update (Payment ID: {payment_id}). Rowcount: {update_result.rowcount}")
-            conn.rollback()
-            return False
-
-        c.execute("SELECT balance FROM users WHERE user_id = ?", (user_id,))
-        new_balance_result = c.fetchone()
-        if new_balance_result: new_balance = Decimal(str(new_balance_result['balance']))
-        else: logger.error(f"Could not fetch new balance for {user_id} after refill update."); conn.rollback(); return False
+    # One refill per user at a time: duplicate IPNs for the same user can't race each other
+    async with _refill_lock(user_id):
+        if _is_recent_payment(payment_id): return True # Credited while we waited for the lock
+        try:
+            status, user_lang, new_balance = await asyncio.to_thread(_do_refill_txn, user_id, amount_float, payment_id)
+        except sqlite3.Error as e:
+            logger.error(f"DB error during process_successful_refill user {user_id} (Payment ID: {payment_id}): {e}", exc_info=PAYMENT_TRACE_ERRORS)
+            return False # Pool rolls back any open transaction on return
+        if status in ('credited', 'duplicate'): _remember_payment(payment_id)
+        if status == 'credited': set_cached_user_lang(user_id, user_lang) # Back on the event loop, after the commit
+
+    if status == 'duplicate':
+        logger.warning(f"Refill payment {payment_id} for user {user_id} was already credited. Skipping duplicate.")
+        return True
+    if status == 'user_not_found':
+        logger.error(f"User {user_id} not found during refill DB update (Payment ID: {payment_id}).")
+        return False
 
-        conn.commit()
-        db_update_successful = True
+    if logger.isEnabledFor(logging.INFO): # Skip the Decimal formatting when INFO is off
         logger.info(f"Successfully processed refill DB update for user {user_id}. Added: {amount_to_add_eur:.2f} EUR. New Balance: {new_balance:.2f} EUR.")
 
+    # Refills landing within the coalesce window are announced in one message:
+    # summed amount, latest balance
+    _pending_refill_added[user_id] = _pending_refill_added.get(user_id, Decimal('0.00')) + amount_to_add_eur
+
+    async def _notify_refill():
+        added_total = _pending_refill_added.pop(user_id, amount_to_add_eur)
+        lang_data = LANGUAGES.get(user_lang, LANGUAGES['en'])
         top_up_success_title = lang_data.get("top_up_success_title", "✅ Top Up Successful!")
         amount_added_label = lang_data.get("amount_added_label", "Amount Added")
         new_balance_label = lang_data.get("new_balance_label", "Your new balance")
         back_to_profile_button = lang_data.get("back_profile_button", "Back to Profile")
 
-        amount_str = format_currency(amount_to_add_eur)
+        amount_str = format_currency(added_total)
         new_balance_str = format_currency(new_balance)
 
         success_msg = (f"{top_up_success_title}\n\n{amount_added_label}: {amount_str} EUR\n"
                        f"{new_balance_label}: {new_balance_str} EUR")
-        keyboard = [[InlineKeyboardButton(f"👤 {back_to_profile_button}", callback_data="profile")]]
+        await throttle_chat_edit(user_id) # Don't land right on top of an invoice edit in the same chat
+        await send_message_with_retry(bot_instance, user_id, success_msg, reply_markup=_button_markup(f"👤 {back_to_profile_button}", "profile"), parse_mode=None)
+
+    # Use a dummy context if necessary, or the provided one
+    bot_instance = context.bot if hasattr(context, 'bot') else None
+    if bot_instance:
+        # Balance is already committed; a failed notification is logged by the coalescer, never reported as a failed refill
+        coalesce_chat_send(user_id, _notify_refill)
+    else:
+        _pending_refill_added.pop(user_id, None)
+        logger.error(f"Could not get bot instance to notify user {user_id} about refill success.")
 
-        # Use a dummy context if necessary, or the provided one
-        bot_instance = context.bot if hasattr(context, 'bot') else None
-        if bot_instance:
-            await send_message_with_retry(bot_instance, user_id, success_msg, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=None)
-        else:
-             logger.error(f"Could not get bot instance to notify user {user_id} about refill success.")
+    return True
 
 
-        return True
+# --- HELPER: Deliver One Purchased Item ---
+_INPUT_MEDIA_BY_TYPE = {'photo': InputMediaPhoto, 'video': InputMediaVideo, 'gif': InputMediaAnimation} # product_media.media_type -> InputMedia class
 
-    except sqlite3.Error as e:
-        logger.error(f"DB error during process_successful_refill user {user_id} (Payment ID: {payment_id}): {e}", exc_info=True)
-        if conn and conn.in_transaction: conn.rollback()
-        return False
-    except Exception as e:
-         logger.error(f"Unexpected error during process_successful_refill user {user_id} (Payment ID: {payment_id}): {e}", exc_info=True)
-         if conn and conn.in_transaction: conn.rollback()
-         return False
-    finally:
-        if conn: conn.close()
+def _open_media_file(file_path: str):
+    """Opens a media file for sending, or returns None if it's missing. Existence check and open share one worker hop."""
+    try: return open(file_path, 'rb')
+    except FileNotFoundError: return None
+
+def _close_media_files(files: list):
+    for f in files:
+        try:
+            if not f.closed: f.close(); logger.debug(f"Closed file handle during cleanup: {getattr(f, 'name', 'unknown')}")
+        except Exception as close_e: logger.warning(f"Error closing file handle '{getattr(f, 'name', 'unknown')}' during cleanup: {close_e}")
+
+async def _send_one_product(context: ContextTypes.DEFAULT_TYPE, chat_id: int, user_id: int, prod_id: int, pickup: tuple, media_list: list | None, send_after: asyncio.Event | None = None):
+    """
+    Delivers one purchased item's pickup details: its media group (caption = details), else a plain text message.
+    Media is prepared right away; if send_after is given, nothing is sent until it is set.
+    """
+    item_name, item_size, item_text, product_type = pickup # (name, size, original_text, product_type)
+    item_text = item_text or "(No specific pickup details provided)"
+    product_emoji = PRODUCT_TYPES.get(product_type, DEFAULT_PRODUCT_EMOJI)
+    item_header = f"--- Item: {product_emoji} {item_name} {item_size} ---"
+
+    media_sent = False; caption_sent_with_media = False; opened_files = []
+    if media_list:
+        media_group_to_send = []
+        caption_text_budget = 1024 - len(item_header) - 2 # Room left after "header\n\n"
+        if len(item_text) <= caption_text_budget: combined_caption = f"{item_header}\n\n{item_text}"
+        else: combined_caption = f"{item_header}\n\n{item_text[:max(caption_text_budget - 3, 0)]}"[:1021] + "..." # Slice before joining: long texts aren't copied whole
+        try:
+            for i, media_item in enumerate(media_list):
+                file_id = media_item['telegram_file_id']
+                media_type = media_item['media_type']
+                file_path = media_item['file_path']
+                caption_to_use = combined_caption if i == 0 else None
+                media_cls = _INPUT_MEDIA_BY_TYPE.get(media_type)
+                if media_cls is None: logger.warning(f"Unsupported media type '{media_type}' P{prod_id}"); continue # Checked before any file is opened
+                try:
+                    if file_id: media_source = file_id
+                    elif file_path and (media_source := await asyncio.to_thread(_open_media_file, file_path)) is not None:
+                        logger.info(f"Opened media file {file_path} P{prod_id} for sending")
+                        opened_files.append(media_source)
+                    else: logger.warning(f"Media item invalid P{prod_id}: No file_id and path '{file_path}' missing."); continue
+                    media_group_to_send.append(media_cls(media=media_source, caption=caption_to_use, parse_mode=None))
+                except Exception as prep_e:
+                    logger.error(f"Error preparing media item {i+1} P{prod_id}: {prep_e}", exc_info=True)
+            if send_after is not None: await send_after.wait() # Previous item is delivered
+            if media_group_to_send:
+                await context.bot.send_media_group(chat_id, media=media_group_to_send, connect_timeout=20, read_timeout=20)
+                logger.info(f"Sent media group with {len(media_group_to_send)} items for P{prod_id} to user {user_id}.")
+                media_sent = True
+                if media_group_to_send[0].caption: caption_sent_with_media = True
+        except telegram_error.TelegramError as tg_err: logger.error(f"TelegramError sending media group for P{prod_id} to user {user_id}: {tg_err}"); caption_sent_with_media = False
+        except Exception as e: logger.error(f"Unexpected error sending media group for P{prod_id} user {user_id}: {e}", exc_info=True); caption_sent_with_media = False
+        finally:
+            if opened_files: await asyncio.to_thread(_close_media_files, opened_files) # One worker hop for all handles
+
+    # Send Text Details ONLY if no media or caption failed
+    if not media_sent or not caption_sent_with_media:
+        if send_after is not None: await send_after.wait()
+        text_to_send = item_text if media_sent else f"{item_header}\n\n{item_text}"
+        if not text_to_send: text_to_send = f"(No details for {item_name} {item_size})"
+        await send_message_with_retry(context.bot, chat_id, text_to_send, parse_mode=None)
 
 
 # --- HELPER: Finalize Purchase (Shared Logic - Modified for Reseller Price) ---
@@ -619,90 +925,117 @@ async def _finalize_purchase(user_id: int, basket_snapshot: list, discount_code_
     lang_data = LANGUAGES.get(lang, LANGUAGES['en'])
     if not basket_snapshot: logger.error(f"Empty basket_snapshot for user {user_id} purchase finalization."); return False
 
-    conn = None
     processed_product_ids = []
     purchases_to_insert = []
-    final_pickup_details = defaultdict(list)
+    final_pickup_details: dict[int, tuple] = {} # product_id -> (name, size, original_text, product_type)
+    media_details = defaultdict(list)
     db_update_successful = False
     total_price_paid_decimal = Decimal('0.0') # Track total actually paid after discounts
 
     try:
-        conn = get_db_connection()
-        c = conn.cursor()
-        c.execute("BEGIN EXCLUSIVE")
-
-        # Get product IDs from snapshot
-        product_ids_in_snapshot = list(set(item['product_id'] for item in basket_snapshot))
-        if not product_ids_in_snapshot:
-            logger.warning(f"Empty snapshot IDs user {user_id} finalization."); conn.rollback(); return False
-
-        placeholders = ','.join('?' * len(product_ids_in_snapshot))
-        # Fetch details needed for processing and pickup info (including original price)
-        c.execute(f"SELECT id, name, product_type, size, price, city, district, original_text FROM products WHERE id IN ({placeholders})", product_ids_in_snapshot)
-        product_db_details = {row['id']: dict(row) for row in c.fetchall()}
-        purchase_time_iso = datetime.now(timezone.utc).isoformat()
-
-        for item_snapshot in basket_snapshot:
-            product_id = item_snapshot['product_id']
-            details = product_db_details.get(product_id)
-            if not details:
-                logger.error(f"CRITICAL: Reserved product {product_id} missing from DB during finalization user {user_id}. Skipping item.")
-                continue
-
-            # Decrement available count
-            avail_update = c.execute("UPDATE products SET available = available - 1 WHERE id = ? AND available > 0", (product_id,))
-            if avail_update.rowcount == 0:
-                logger.error(f"CRITICAL: Failed available decrement for reserved product P{product_id} user {user_id}. Race condition or logic error?")
-                continue
-
-            # --- Calculate Price Paid (Original - Reseller Discount) ---
-            item_original_price_decimal = Decimal(str(details['price']))
-            item_product_type = details['product_type']
-            item_reseller_discount_percent = get_reseller_discount(user_id, item_product_type)
-            item_reseller_discount_amount = (item_original_price_decimal * item_reseller_discount_percent / Decimal('100')).quantize(Decimal('0.01'), rounding=ROUND_DOWN)
-            item_price_paid_decimal = item_original_price_decimal - item_reseller_discount_amount
-            # --- End Calculation ---
-
-            total_price_paid_decimal += item_price_paid_decimal # Sum ACTUAL price paid
-            item_price_paid_float = float(item_price_paid_decimal) # Convert to float for DB insert
-
-            # <<< Use item_price_paid_float for purchase record >>>
-            purchases_to_insert.append((
-                user_id, product_id, details['name'], item_product_type, details['size'],
-                item_price_paid_float, details['city'], details['district'], purchase_time_iso
-            ))
-            processed_product_ids.append(product_id)
-            final_pickup_details[product_id].append({'name': details['name'], 'size': details['size'], 'text': details.get('original_text')})
-
-        if not purchases_to_insert:
-            logger.warning(f"No items processed during finalization for user {user_id}. Rolling back.")
-            conn.rollback()
-            if chat_id: await send_message_with_retry(context.bot, chat_id, lang_data.get("error_processing_purchase_contact_support", "❌ Error processing purchase."), parse_mode=None)
-            return False
-
-        # Record Purchases & Update User Stats
-        c.executemany("INSERT INTO purchases (user_id, product_id, product_name, product_type, product_size, price_paid, city, district, purchase_date) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", purchases_to_insert)
-        c.execute("UPDATE users SET total_purchases = total_purchases + ? WHERE user_id = ?", (len(purchases_to_insert), user_id))
-
-        # Increment general discount code usage if applicable
-        if discount_code_used:
-            logger.info(f"Incrementing usage count for general discount code '{discount_code_used}' used by {user_id}.")
-            c.execute("UPDATE discount_codes SET uses_count = uses_count + 1 WHERE code = ?", (discount_code_used,))
-
-        # Clear user's basket in DB
-        c.execute("UPDATE users SET basket = '' WHERE user_id = ?", (user_id,))
-        conn.commit()
-        db_update_successful = True
-        logger.info(f"Finalized purchase DB update user {user_id}. Processed {len(purchases_to_insert)} items. General Discount: {discount_code_used or 'None'}. Total Paid (after reseller disc): {total_price_paid_decimal:.2f} EUR")
+        with pooled_db_connection() as conn:
+            c = conn.cursor()
+            c.execute("BEGIN IMMEDIATE") # Take the write lock up front: no SQLITE_BUSY upgrade mid-transaction
+
+            # Get product IDs from snapshot
+            product_ids_in_snapshot = list(set(item['product_id'] for item in basket_snapshot))
+            if not product_ids_in_snapshot:
+                logger.warning(f"Empty snapshot IDs user {user_id} finalization."); return False # Pool rolls back on return
+
+            placeholders = ','.join('?' * len(product_ids_in_snapshot))
+            # Fetch details needed for processing and pickup info (including original price)
+            c.execute(f"SELECT id, name, product_type, size, price, city, district, original_text, available FROM products WHERE id IN ({placeholders})", product_ids_in_snapshot)
+            product_db_details = {row['id']: row for row in c.fetchall()} # sqlite3.Row supports ['col']; no per-row dict copy
+            purchase_time_iso = datetime.now(timezone.utc).isoformat()
+            # Stock read above is stable (write lock held), so decrements are allotted here and applied in one batch
+            remaining_stock = {pid: details['available'] for pid, details in product_db_details.items()}
+            decrements = Counter()
+            reseller_discount_memo: dict[str, Decimal] = {} # product_type -> reseller discount %, for this basket only
+            paid_price_memo: dict[tuple, tuple[Decimal, float]] = {} # (product_type, price) -> price paid
+
+            for item_snapshot in basket_snapshot:
+                product_id = item_snapshot['product_id']
+                details = product_db_details.get(product_id)
+                if not details:
+                    logger.error(f"CRITICAL: Reserved product {product_id} missing from DB during finalization user {user_id}. Skipping item.")
+                    continue
+
+                # Allot available count (applied below)
+                if remaining_stock[product_id] <= 0:
+                    logger.error(f"CRITICAL: Failed available decrement for reserved product P{product_id} user {user_id}. Race condition or logic error?")
+                    continue
+                remaining_stock[product_id] -= 1
+                decrements[product_id] += 1
+
+                # --- Calculate Price Paid (Original - Reseller Discount) ---
+                item_product_type = details['product_type']
+                price_key = (item_product_type, details['price'])
+                if price_key not in paid_price_memo: # Baskets repeat type/price pairs; compute each pair once
+                    if item_product_type not in reseller_discount_memo: # One discount lookup per type
+                        reseller_discount_memo[item_product_type] = get_reseller_discount(user_id, item_product_type)
+                    item_original_price_decimal = Decimal(str(details['price']))
+                    item_reseller_discount_amount = (item_original_price_decimal * reseller_discount_memo[item_product_type] / Decimal('100')).quantize(Decimal('0.01'), rounding=ROUND_DOWN)
+                    item_price_paid_decimal = item_original_price_decimal - item_reseller_discount_amount
+                    paid_price_memo[price_key] = (item_price_paid_decimal, float(item_price_paid_decimal)) # Float for DB insert
+                item_price_paid_decimal, item_price_paid_float = paid_price_memo[price_key]
+                # --- End Calculation ---
+
+                total_price_paid_decimal += item_price_paid_decimal # Sum ACTUAL price paid
+
+                # <<< Use item_price_paid_float for purchase record >>>
+                purchases_to_insert.append((
+                    user_id, product_id, details['name'], item_product_type, details['size'],
+                    item_price_paid_float, details['city'], details['district'], purchase_time_iso
+                ))
+                processed_product_ids.append(product_id)
+                final_pickup_details[product_id] = (details['name'], details['size'], details['original_text'], item_product_type)
+
+            if not purchases_to_insert:
+                logger.warning(f"No items processed during finalization for user {user_id}. Rolling back.")
+                conn.rollback() # Explicit: release the write lock before awaiting Telegram
+                if chat_id: await send_message_with_retry(context.bot, chat_id, lang_data.get("error_processing_purchase_contact_support", "❌ Error processing purchase."), parse_mode=None)
+                return False
+
+            # Decrement available counts (one statement; RETURNING reports which decrements applied, SQLite >= 3.35 is enforced by init_db) & Record Purchases & Update User Stats
+            decrement_values = ','.join(['(?, ?)'] * len(decrements))
+            c.execute(f"""UPDATE products SET available = available - d.n
+                          FROM (SELECT column1 AS id, column2 AS n FROM (VALUES {decrement_values})) AS d
+                          WHERE products.id = d.id AND products.available >= d.n RETURNING products.id""",
+                      [v for pid_n in decrements.items() for v in pid_n])
+            missed_decrements = set(decrements) - {row['id'] for row in c.fetchall()}
+            if missed_decrements: # Never record a sale whose stock wasn't taken
+                logger.error(f"CRITICAL: Stock decrement did not apply for products {sorted(missed_decrements)} user {user_id}. Rolling back purchase.")
+                conn.rollback() # Explicit: release the write lock before awaiting Telegram
+                if chat_id: await send_message_with_retry(context.bot, chat_id, lang_data.get("error_processing_purchase_contact_support", "❌ Error processing purchase."), parse_mode=None)
+                return False
+            c.executemany("INSERT INTO purchases (user_id, product_id, product_name, product_type, product_size, price_paid, city, district, purchase_date) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", purchases_to_insert)
+            c.execute("UPDATE users SET total_purchases = total_purchases + ? WHERE user_id = ?", (len(purchases_to_insert), user_id))
+
+            # Increment general discount code usage if applicable
+            if discount_code_used:
+                logger.info(f"Incrementing usage count for general discount code '{discount_code_used}' used by {user_id}.")
+                c.execute("UPDATE discount_codes SET uses_count = uses_count + 1 WHERE code = ?", (discount_code_used,))
+
+            # Clear user's basket in DB
+            c.execute("UPDATE users SET basket = '' WHERE user_id = ?", (user_id,))
+
+            # Read the media to deliver, then remove the sold products - all in this one transaction
+            media_placeholders = ','.join('?' * len(processed_product_ids))
+            for row in c.execute(f"SELECT product_id, media_type, telegram_file_id, file_path FROM product_media WHERE product_id IN ({media_placeholders})", processed_product_ids):
+                media_details[row['product_id']].append(row)
+            ids_tuple_list = [(pid,) for pid in processed_product_ids]
+            c.executemany("DELETE FROM product_media WHERE product_id = ?", ids_tuple_list)
+            delete_result = c.executemany("DELETE FROM products WHERE id = ?", ids_tuple_list)
+
+            conn.commit()
+            db_update_successful = True
+            logger.info(f"Finalized purchase DB update user {user_id}. Processed {len(purchases_to_insert)} items. General Discount: {discount_code_used or 'None'}. Total Paid (after reseller disc): {total_price_paid_decimal:.2f} EUR")
+            logger.info(f"Deleted {delete_result.rowcount} purchased product records.")
 
-    except sqlite3.Error as e:
+    except sqlite3.Error as e: # Pool rolls back any open transaction on return
         logger.error(f"DB error during purchase finalization user {user_id}: {e}", exc_info=True); db_update_successful = False
-        if conn and conn.in_transaction: conn.rollback()
     except Exception as e:
         logger.error(f"Unexpected error during purchase finalization user {user_id}: {e}", exc_info=True); db_update_successful = False
-        if conn and conn.in_transaction: conn.rollback()
-    finally:
-        if conn: conn.close()
 
     # --- Post-Transaction Cleanup & Message Sending (If DB success) ---
     if db_update_successful:
@@ -710,114 +1043,34 @@ async def _finalize_purchase(user_id: int, basket_snapshot: list, discount_code_
         context.user_data['basket'] = []
         context.user_data.pop('applied_discount', None)
 
-        # Fetch Media
-        media_details = defaultdict(list)
-        if processed_product_ids:
-            conn_media = None
-            try:
-                conn_media = get_db_connection()
-                c_media = conn_media.cursor()
-                media_placeholders = ','.join('?' * len(processed_product_ids))
-                c_media.execute(f"SELECT product_id, media_type, telegram_file_id, file_path FROM product_media WHERE product_id IN ({media_placeholders})", processed_product_ids)
-                for row in c_media.fetchall(): media_details[row['product_id']].append(dict(row))
-            except sqlite3.Error as e: logger.error(f"DB error fetching media post-purchase: {e}")
-            finally:
-                if conn_media: conn_media.close()
-
         # Send Pickup Details
         if chat_id: # Only attempt if we have a chat_id
             success_title = lang_data.get("purchase_success", "🎉 Purchase Complete! Pickup details below:")
             await send_message_with_retry(context.bot, chat_id, success_title, parse_mode=None)
 
-            for prod_id in processed_product_ids:
-                item_details_list = final_pickup_details.get(prod_id)
-                if not item_details_list: continue
-                item_details = item_details_list[0]
-                item_name, item_size = item_details['name'], item_details['size']
-                item_text = item_details['text'] or "(No specific pickup details provided)"
-                product_type = product_db_details.get(prod_id, {}).get('product_type', 'Product')
-                product_emoji = PRODUCT_TYPES.get(product_type, DEFAULT_PRODUCT_EMOJI)
-                item_header = f"--- Item: {product_emoji} {item_name} {item_size} ---"
-
-                media_sent = False; caption_sent_with_media = False; opened_files = []
-                if prod_id in media_details:
-                     media_list = media_details[prod_id]
-                     if media_list:
-                        media_group_to_send = []
-                        combined_caption = f"{item_header}\n\n{item_text}"
-                        if len(combined_caption) > 1024: combined_caption = combined_caption[:1021] + "..."
-                        try:
-                            for i, media_item in enumerate(media_list):
-                                file_id = media_item.get('telegram_file_id')
-                                media_type = media_item.get('media_type')
-                                file_path = media_item.get('file_path')
-                                caption_to_use = combined_caption if i == 0 else None
-                                input_media = None; file_handle = None
-                                try:
-                                    if file_id:
-                                        if media_type == 'photo': input_media = InputMediaPhoto(media=file_id, caption=caption_to_use, parse_mode=None)
-                                        elif media_type == 'video': input_media = InputMediaVideo(media=file_id, caption=caption_to_use, parse_mode=None)
-                                        elif media_type == 'gif': input_media = InputMediaAnimation(media=file_id, caption=caption_to_use, parse_mode=None)
-                                        else: logger.warning(f"Unsupported media type '{media_type}' with file_id P{prod_id}"); continue
-                                    elif file_path and await asyncio.to_thread(os.path.exists, file_path):
-                                        logger.info(f"Opening media file {file_path} P{prod_id} for sending")
-                                        file_handle = await asyncio.to_thread(open, file_path, 'rb')
-                                        opened_files.append(file_handle)
-                                        if media_type == 'photo': input_media = InputMediaPhoto(media=file_handle, caption=caption_to_use, parse_mode=None)
-                                        elif media_type == 'video': input_media = InputMediaVideo(media=file_handle, caption=caption_to_use, parse_mode=None)
-                                        elif media_type == 'gif': input_media = InputMediaAnimation(media=file_handle, caption=caption_to_use, parse_mode=None)
-                                        else: logger.warning(f"Unsupported media type '{media_type}' from path {file_path}"); await asyncio.to_thread(file_handle.close); opened_files.remove(file_handle); continue
-                                    else: logger.warning(f"Media item invalid P{prod_id}: No file_id and path '{file_path}' missing."); continue
-                                    if input_media: media_group_to_send.append(input_media)
-                                except Exception as prep_e:
-                                    logger.error(f"Error preparing media item {i+1} P{prod_id}: {prep_e}", exc_info=True)
-                                    if file_handle and file_handle in opened_files: await asyncio.to_thread(file_handle.close); opened_files.remove(file_handle)
-                            if media_group_to_send:
-                                await context.bot.send_media_group(chat_id, media=media_group_to_send, connect_timeout=20, read_timeout=20)
-                                logger.info(f"Sent media group with {len(media_group_to_send)} items for P{prod_id} to user {user_id}.")
-                                media_sent = True
-                                if media_group_to_send[0].caption: caption_sent_with_media = True
-                        except telegram_error.TelegramError as tg_err: logger.error(f"TelegramError sending media group for P{prod_id} to user {user_id}: {tg_err}"); caption_sent_with_media = False
-                        except Exception as e: logger.error(f"Unexpected error sending media group for P{prod_id} user {user_id}: {e}", exc_info=True); caption_sent_with_media = False
-                        finally:
-                            for f in opened_files:
-                                try:
-                                    if not f.closed: await asyncio.to_thread(f.close); logger.debug(f"Closed file handle during cleanup: {getattr(f, 'name', 'unknown')}")
-                                except Exception as close_e: logger.warning(f"Error closing file handle '{getattr(f, 'name', 'unknown')}' during cleanup: {close_e}")
-
-                # Send Text Details ONLY if no media or caption failed
-                if not media_sent or not caption_sent_with_media:
-                    text_to_send = item_text if media_sent else f"{item_header}\n\n{item_text}"
-                    if not text_to_send: text_to_send = f"(No details for {item_name} {item_size})"
-                    await send_message_with_retry(context.bot, chat_id, text_to_send, parse_mode=None)
-
-        # Delete Product Records and Media Directories Async
-        conn_del = None
+            # Items prepare their media concurrently but send one at a time, in basket order:
+            # a burst of media groups to one chat would trip Telegram's per-chat flood limit
+            item_sent = [asyncio.Event() for _ in processed_product_ids]
+            async def _deliver_item(i: int, prod_id: int):
+                try: await _send_one_product(context, chat_id, user_id, prod_id, final_pickup_details[prod_id], media_details.get(prod_id), item_sent[i - 1] if i else None)
+                finally: item_sent[i].set() # Release the next item even if this one failed
+            send_results = await asyncio.gather(*(_deliver_item(i, prod_id) for i, prod_id in enumerate(processed_product_ids)), return_exceptions=True)
+            for send_result in send_results:
+                if isinstance(send_result, Exception): logger.error(f"Error delivering purchased item to user {user_id}: {send_result}", exc_info=send_result)
+
+        # Delete Media Directories Async (product rows were removed in the purchase transaction; files were needed until now)
         try:
-            conn_del = get_db_connection()
-            c_del = conn_del.cursor()
-            ids_tuple_list = [(pid,) for pid in processed_product_ids]
-            c_del.executemany("DELETE FROM product_media WHERE product_id = ?", ids_tuple_list)
-            delete_result = c_del.executemany("DELETE FROM products WHERE id = ?", ids_tuple_list)
-            conn_del.commit()
-            deleted_count = delete_result.rowcount
-            logger.info(f"Attempted deletion of {len(processed_product_ids)} purchased product records (Result: {deleted_count}).")
-            for prod_id in processed_product_ids:
+            for prod_id in set(processed_product_ids): # No existence check: rmtree(ignore_errors=True) skips missing dirs
                  media_dir_to_delete = os.path.join(MEDIA_DIR, str(prod_id))
-                 if await asyncio.to_thread(os.path.exists, media_dir_to_delete):
-                     asyncio.create_task(asyncio.to_thread(shutil.rmtree, media_dir_to_delete, ignore_errors=True))
-                     logger.info(f"Scheduled deletion of media dir: {media_dir_to_delete}")
-        except sqlite3.Error as e: logger.error(f"DB error deleting purchased products: {e}", exc_info=True); conn_del.rollback() if conn_del and conn_del.in_transaction else None
-        except Exception as e: logger.error(f"Unexpected error deleting purchased products: {e}", exc_info=True)
-        finally:
-            if conn_del: conn_del.close()
+                 asyncio.create_task(asyncio.to_thread(shutil.rmtree, media_dir_to_delete, ignore_errors=True))
+                 logger.info(f"Scheduled deletion of media dir: {media_dir_to_delete}")
+        except Exception as e: logger.error(f"Unexpected error deleting purchased product media: {e}", exc_info=True)
 
         # Final Message
         if chat_id:
              final_message_parts = ["Purchase details sent above."]
              leave_review_button = lang_data.get("leave_review_button", "Leave a Review")
-             keyboard = [[InlineKeyboardButton(f"✍️ {leave_review_button}", callback_data="leave_review_now")]]
-             await send_message_with_retry(context.bot, chat_id, "\n\n".join(final_message_parts), reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=None)
+             await send_message_with_retry(context.bot, chat_id, "\n\n".join(final_message_parts), reply_markup=_button_markup(f"✍️ {leave_review_button}", "leave_review_now"), parse_mode=None)
 
         return True # Indicate success
     else: # Purchase failed at DB level
@@ -839,37 +1092,33 @@ async def process_purchase_with_balance(user_id: int, amount_to_deduct: Decimal,
     if not basket_snapshot: logger.error(f"Empty basket_snapshot for user {user_id} balance purchase."); return False
     if not isinstance(amount_to_deduct, Decimal) or amount_to_deduct < Decimal('0.0'): logger.error(f"Invalid amount_to_deduct {amount_to_deduct}."); return False
 
-    conn = None
     db_balance_deducted = False
+    balance_insufficient = False
     balance_changed_error = lang_data.get("balance_changed_error", "❌ Transaction failed: Balance changed.")
     error_processing_purchase_contact_support = lang_data.get("error_processing_purchase_contact_support", "❌ Error processing purchase. Contact support.")
 
     try:
-        conn = get_db_connection()
-        c = conn.cursor()
-        c.execute("BEGIN EXCLUSIVE")
-        # 1. Verify balance
-        c.execute("SELECT balance FROM users WHERE user_id = ?", (user_id,))
-        current_balance_result = c.fetchone()
-        if not current_balance_result or Decimal(str(current_balance_result['balance'])) < amount_to_deduct:
-             logger.warning(f"Insufficient balance user {user_id}. Needed: {amount_to_deduct:.2f}")
-             conn.rollback()
-             if chat_id: await send_message_with_retry(context.bot, chat_id, balance_changed_error, parse_mode=None)
-             return False
-        # 2. Deduct balance
-        amount_float_to_deduct = float(amount_to_deduct)
-        update_res = c.execute("UPDATE users SET balance = balance - ? WHERE user_id = ?", (amount_float_to_deduct, user_id))
-        if update_res.rowcount == 0: logger.error(f"Failed to deduct balance user {user_id}."); conn.rollback(); return False
-
-        conn.commit() # Commit balance deduction *before* finalizing items
-        db_balance_deducted = True
-        logger.info(f"Deducted {amount_to_deduct:.2f} EUR from balance for user {user_id}.")
-
-    except sqlite3.Error as e:
+        with pooled_db_connection() as conn:
+            c = conn.cursor()
+            c.execute("BEGIN IMMEDIATE") # Take the write lock up front: no SQLITE_BUSY upgrade mid-transaction
+            # Verify and deduct balance in one statement: no row back means unknown user or insufficient balance.
+            # ROUND keeps the balance on a cent boundary, as in refills.
+            amount_float_to_deduct = float(amount_to_deduct)
+            new_balance_row = c.execute("UPDATE users SET balance = ROUND(balance - ?, 2) WHERE user_id = ? AND balance >= ? RETURNING balance", (amount_float_to_deduct, user_id, amount_float_to_deduct)).fetchone()
+            if new_balance_row is None:
+                 logger.warning(f"Insufficient balance user {user_id}. Needed: {amount_to_deduct:.2f}")
+                 balance_insufficient = True # Pool rolls back on return; user is told below, after the connection is back in the pool
+            else:
+                conn.commit() # Commit balance deduction *before* finalizing items
+                db_balance_deducted = True
+                logger.info(f"Deducted {amount_to_deduct:.2f} EUR from balance for user {user_id}. New balance: {new_balance_row['balance']:.2f} EUR.")
+
+    except sqlite3.Error as e: # Pool rolls back any open transaction on return
         logger.error(f"DB error deducting balance user {user_id}: {e}", exc_info=True); db_balance_deducted = False
-        if conn and conn.in_transaction: conn.rollback()
-    finally:
-        if conn: conn.close()
+
+    if balance_insufficient:
+        if chat_id: await send_message_with_retry(context.bot, chat_id, balance_changed_error, parse_mode=None)
+        return False
 
     # 3. Finalize purchase ONLY if balance was successfully deducted
     if db_balance_deducted:
@@ -911,13 +1160,13 @@ async def process_successful_crypto_purchase(user_id: int, basket_snapshot: list
     else:
         # Finalization failed even after payment confirmed. This is bad.
         logger.error(f"CRITICAL: Crypto payment {payment_id} success for user {user_id}, but _finalize_purchase failed! Items paid for but not processed in DB correctly.")
-        if ADMIN_ID and chat_id:
-            try:
-                await send_message_with_retry(context.bot, ADMIN_ID, f"⚠️ Critical Issue: Crypto payment {payment_id} success for user {user_id}, but finalization FAILED! Manual check/correction needed.", parse_mode=None)
-            except Exception as admin_notify_e:
-                 logger.error(f"Failed to notify admin about critical finalization failure: {admin_notify_e}")
         if chat_id:
-            await send_message_with_retry(context.bot, chat_id, lang_data.get("error_processing_purchase_contact_support", "❌ Error processing purchase. Contact support."), parse_mode=None)
+            # Admin alert and user notice are independent: send them concurrently
+            notify_admin = send_message_with_retry(context.bot, ADMIN_ID, f"⚠️ Critical Issue: Crypto payment {payment_id} success for user {user_id}, but finalization FAILED! Manual check/correction needed.", parse_mode=None) if ADMIN_ID else asyncio.sleep(0)
+            notify_user = send_message_with_retry(context.bot, chat_id, lang_data.get("error_processing_purchase_contact_support", "❌ Error processing purchase. Contact support."), parse_mode=None)
+            admin_notify_result, user_notify_result = await asyncio.gather(notify_admin, notify_user, return_exceptions=True)
+            if isinstance(admin_notify_result, Exception): logger.error(f"Failed to notify admin about critical finalization failure: {admin_notify_result}")
+            if isinstance(user_notify_result, Exception): logger.error(f"Failed to notify user {user_id} about finalization failure: {user_notify_result}")
 
 
     return finalize_success
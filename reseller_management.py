@@ -2,8 +2,11 @@
 
 import sqlite3
 import logging
-from decimal import Decimal, ROUND_DOWN # Use Decimal for precision
+import asyncio
+from decimal import Decimal, ROUND_DOWN, ROUND_HALF_UP # Use Decimal for precision
 import math # For pagination calculation
+from collections import OrderedDict
+from functools import lru_cache
 
 # --- Telegram Imports ---
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
@@ -13,8 +16,9 @@ import telegram.error as telegram_error
 
 # Import shared elements from utils
 from utils import (
-    ADMIN_ID, LANGUAGES, get_db_connection, send_message_with_retry,
-    PRODUCT_TYPES, format_currency, log_admin_action, load_all_data,
+    ADMIN_ID, LANGUAGES, pooled_db_connection, send_message_with_retry,
+    PRODUCT_TYPES, format_currency, log_admin_action, get_product_types_cached,
+    get_product_types_version, spawn_background_task,
     DEFAULT_PRODUCT_EMOJI,
     # Import action constants for logging
     ACTION_RESELLER_ENABLED, ACTION_RESELLER_DISABLED,
@@ -27,36 +31,63 @@ logger = logging.getLogger(__name__)
 
 # Constants
 USERS_PER_PAGE_DISCOUNT_SELECT = 10 # Keep for selecting reseller for discount mgmt
+# Reseller list page rows plus the overall reseller count (a constant subquery, unaffected by the page's range filter)
+_RESELLER_PAGE_SELECT = "SELECT user_id, username, (SELECT COUNT(*) FROM users WHERE is_reseller = 1) AS total FROM users WHERE is_reseller = 1"
+RESELLER_DISCOUNT_CACHE_MAX = 4096
+_ZERO_DISCOUNT = Decimal('0.0') # Decimals are immutable, so one shared instance is safe to return
+_HUNDRED_PERCENT = Decimal('100.0')
+
+# (user_id, product_type) -> discount %, LRU order. Discounts only change through the admin
+# handlers, which call invalidate_reseller_discounts after committing.
+_reseller_discount_cache: OrderedDict[tuple[int, str], Decimal] = OrderedDict()
+
+def invalidate_reseller_discounts(user_id: int | None = None):
+    """Drops cached discounts for one reseller (all product types), or for everyone when user_id is None."""
+    if user_id is None: _reseller_discount_cache.clear(); return
+    for key in [k for k in _reseller_discount_cache if k[0] == user_id]: del _reseller_discount_cache[key]
 
 # --- Helper Function to Get Reseller Discount ---
-# (Keep this function as is)
+def _bp_to_percent(basis_points: int) -> Decimal:
+    """Exact Decimal percentage from stored basis points (1550 -> 15.50)."""
+    return Decimal(basis_points).scaleb(-2)
+
+# One statement: no row unless the user is an active reseller with a rule for the type.
+# Served by the users primary key and the reseller_discounts (reseller_user_id, product_type) primary key.
+_RESELLER_DISCOUNT_SQL = """
+    SELECT rd.discount_bp FROM users u
+    JOIN reseller_discounts rd ON rd.reseller_user_id = u.user_id AND rd.product_type = ?
+    WHERE u.user_id = ? AND u.is_reseller = 1
+"""
+
 def get_reseller_discount(user_id: int, product_type: str) -> Decimal:
-    """Fetches the discount percentage for a specific reseller and product type."""
-    discount = Decimal('0.0')
-    conn = None
+    """Fetches the discount percentage for a specific reseller and product type (cached until an admin changes it)."""
+    cache_key = (user_id, product_type)
+    discount = _reseller_discount_cache.get(cache_key)
+    if discount is not None:
+        _reseller_discount_cache.move_to_end(cache_key)
+        return discount
+    discount = _ZERO_DISCOUNT
     try:
-        conn = get_db_connection()
-        c = conn.cursor()
-        c.execute("SELECT is_reseller FROM users WHERE user_id = ?", (user_id,))
-        res = c.fetchone()
-        if res and res['is_reseller'] == 1:
-            c.execute("""
-                SELECT discount_percentage FROM reseller_discounts
-                WHERE reseller_user_id = ? AND product_type = ?
-            """, (user_id, product_type))
-            discount_res = c.fetchone()
+        with pooled_db_connection() as conn:
+            discount_res = conn.execute(_RESELLER_DISCOUNT_SQL, (product_type, user_id)).fetchone()
             if discount_res:
-                discount = Decimal(str(discount_res['discount_percentage']))
+                discount = _bp_to_percent(discount_res['discount_bp'])
                 logger.debug(f"Found reseller discount for user {user_id}, type {product_type}: {discount}%")
+        # Only successful lookups are cached; DB errors fall through to the uncached 0.0 below
+        _reseller_discount_cache[cache_key] = discount
+        if len(_reseller_discount_cache) > RESELLER_DISCOUNT_CACHE_MAX: _reseller_discount_cache.popitem(last=False)
     except sqlite3.Error as e:
         logger.error(f"DB error fetching reseller discount for user {user_id}, type {product_type}: {e}")
     except Exception as e:
         logger.error(f"Unexpected error fetching reseller discount: {e}", exc_info=True)
-    finally:
-        if conn: conn.close()
     return discount
 
 
+def _answer_in_background(query, text: str):
+    """Shows an alert for a rejected callback without waiting on the round-trip; guard paths return right after."""
+    spawn_background_task(query.answer(text, show_alert=True))
+
+
 # ==================================
 # --- Admin: Manage Reseller Status --- (REVISED FLOW)
 # ==================================
@@ -64,7 +95,7 @@ def get_reseller_discount(user_id: int, product_type: str) -> Decimal:
 async def handle_manage_resellers_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Prompts admin to enter the User ID to manage reseller status."""
     query = update.callback_query
-    if query.from_user.id != ADMIN_ID: return await query.answer("Access Denied.", show_alert=True)
+    if query.from_user.id != ADMIN_ID: return _answer_in_background(query, "Access Denied.")
 
     # Set state to expect a user ID message
     context.user_data['state'] = 'awaiting_reseller_manage_id'
@@ -77,6 +108,78 @@ async def handle_manage_resellers_menu(update: Update, context: ContextTypes.DEF
     await query.answer("Enter User ID in chat.")
 
 
+# Rows shared by every reseller status screen (buttons are immutable, so reusing them is safe)
+_TOGGLE_KB_BACK_ROWS = (
+    (InlineKeyboardButton("⬅️ Manage Another User", callback_data="manage_resellers_menu"),), # Back to the prompt
+    (InlineKeyboardButton("⬅️ Back to Admin Menu", callback_data="admin_menu"),),
+)
+
+def _build_toggle_kb(uid: int, is_reseller: bool) -> InlineKeyboardMarkup:
+    toggle_label = "🚫 Disable Reseller Status" if is_reseller else "✅ Enable Reseller Status"
+    toggle_row = (InlineKeyboardButton(toggle_label, callback_data=f"reseller_toggle_status|{uid}|0"),) # Offset 0 as placeholder
+    return InlineKeyboardMarkup((toggle_row,) + _TOGGLE_KB_BACK_ROWS)
+
+# --- Sync DB helpers (run via asyncio.to_thread so SQLite I/O stays off the event loop) ---
+def _fetch_reseller_candidate_sync(user_id: int):
+    with pooled_db_connection() as conn:
+        return conn.execute("SELECT user_id, username, is_reseller FROM users WHERE user_id = ?", (user_id,)).fetchone()
+
+def _toggle_reseller_sync(user_id: int):
+    """Flips is_reseller and returns (username, is_reseller) after the change, or None if the user doesn't exist."""
+    with pooled_db_connection() as conn:
+        # CASE rather than 1 - is_reseller so a NULL flag toggles on, as before
+        user_data = conn.execute("UPDATE users SET is_reseller = CASE WHEN is_reseller = 1 THEN 0 ELSE 1 END WHERE user_id = ? RETURNING username, is_reseller", (user_id,)).fetchone()
+        if user_data: conn.commit()
+        return user_data
+
+def _fetch_reseller_page_sync(cursor: tuple[str, int] | None) -> tuple[list, int]:
+    """Returns the page's rows and how many resellers come before its first row (for the page number)."""
+    with pooled_db_connection() as conn:
+        # Page and total count in one statement; the keyset range keeps deep pages as cheap as the first
+        if cursor is None: # First page
+            rows = conn.execute(f"{_RESELLER_PAGE_SELECT} ORDER BY user_id DESC LIMIT ?", (USERS_PER_PAGE_DISCOUNT_SELECT,)).fetchall()
+        elif cursor[0] == 'n':
+            rows = conn.execute(f"{_RESELLER_PAGE_SELECT} AND user_id < ? ORDER BY user_id DESC LIMIT ?", (cursor[1], USERS_PER_PAGE_DISCOUNT_SELECT)).fetchall()
+        else: # Prev: nearest rows above the cursor, flipped back to descending order
+            rows = conn.execute(f"{_RESELLER_PAGE_SELECT} AND user_id > ? ORDER BY user_id ASC LIMIT ?", (cursor[1], USERS_PER_PAGE_DISCOUNT_SELECT)).fetchall()[::-1]
+        if not rows or cursor is None: return rows, 0
+        # Counted from the rows actually shown, so the page label can't drift from them
+        return rows, conn.execute("SELECT COUNT(*) FROM users WHERE is_reseller = 1 AND user_id > ?", (rows[0]['user_id'],)).fetchone()[0]
+
+def _fetch_reseller_discounts_sync(reseller_id: int) -> tuple[str | None, list]:
+    with pooled_db_connection() as conn:
+        # One statement: the username repeats on every rule row, and a user with no rules yields one row with NULL rule columns
+        rows = conn.execute("""
+            SELECT u.username, rd.product_type, rd.discount_bp, COALESCE(pt.emoji, ?) AS emoji
+            FROM users u
+            LEFT JOIN reseller_discounts rd ON rd.reseller_user_id = u.user_id
+            LEFT JOIN product_types pt ON pt.name = rd.product_type
+            WHERE u.user_id = ? ORDER BY rd.product_type
+        """, (DEFAULT_PRODUCT_EMOJI, reseller_id)).fetchall()
+    if not rows: return None, [] # Unknown user (discount rows can't outlive it: FK cascade)
+    return rows[0]['username'], [row for row in rows if row['product_type'] is not None]
+
+def _save_reseller_discount_sync(user_id: int, product_type: str, discount_bp: int, mode: str) -> float | None:
+    """Adds or updates one discount rule; returns the previous percentage for edits (None if there was no rule)."""
+    old_value = None
+    with pooled_db_connection() as conn: # Pool rolls back on error
+        c = conn.cursor()
+        c.execute("BEGIN")
+
+        if mode == 'edit':
+            c.execute("SELECT discount_bp FROM reseller_discounts WHERE reseller_user_id = ? AND product_type = ?", (user_id, product_type))
+            old_res = c.fetchone()
+            old_value = old_res['discount_bp'] / 100 if old_res else None
+
+        # One upsert for both add and edit: updates the existing row in place (INSERT OR REPLACE deleted and re-inserted it)
+        # If it's an 'edit' but the row doesn't exist, it becomes an 'add'
+        sql = """INSERT INTO reseller_discounts (reseller_user_id, product_type, discount_bp, discount_percentage) VALUES (?, ?, ?, ?)
+                 ON CONFLICT(reseller_user_id, product_type) DO UPDATE SET discount_bp = excluded.discount_bp, discount_percentage = excluded.discount_percentage"""
+        c.execute(sql, (user_id, product_type, discount_bp, discount_bp / 100)) # Legacy REAL column
+        conn.commit()
+    return old_value
+
+
 async def handle_reseller_manage_id_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handles the admin entering a User ID for reseller status management."""
     admin_id = update.effective_user.id
@@ -103,26 +206,18 @@ async def handle_reseller_manage_id_message(update: Update, context: ContextType
     context.user_data.pop('state', None)
 
     # Fetch user info
-    conn = None
     user_info = None
     try:
-        conn = get_db_connection()
-        c = conn.cursor()
-        c.execute("SELECT user_id, username, is_reseller FROM users WHERE user_id = ?", (target_user_id,))
-        user_info = c.fetchone()
+        user_info = await asyncio.to_thread(_fetch_reseller_candidate_sync, target_user_id)
     except sqlite3.Error as e:
         logger.error(f"DB error fetching user {target_user_id} for reseller check: {e}")
-        await send_message_with_retry(context.bot, chat_id, "❌ Database error checking user.", parse_mode=None)
-        # Go back to admin menu on error
-        await send_message_with_retry(context.bot, chat_id, "Returning to menu...", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Admin Menu", callback_data="admin_menu")]]), parse_mode=None)
+        # Go back to admin menu on error (one message carries both the error and the Back button)
+        await send_message_with_retry(context.bot, chat_id, "❌ Database error checking user.\n\nReturning to menu...", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Admin Menu", callback_data="admin_menu")]]), parse_mode=None)
         return
-    finally:
-        if conn: conn.close()
 
     if not user_info:
-        await send_message_with_retry(context.bot, chat_id, f"❌ User ID {target_user_id} not found in the bot's database.", parse_mode=None)
         # Go back to admin menu
-        await send_message_with_retry(context.bot, chat_id, "Returning to menu...", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Admin Menu", callback_data="admin_menu")]]), parse_mode=None)
+        await send_message_with_retry(context.bot, chat_id, f"❌ User ID {target_user_id} not found in the bot's database.\n\nReturning to menu...", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Admin Menu", callback_data="admin_menu")]]), parse_mode=None)
         return
 
     # Display user info and toggle buttons
@@ -133,16 +228,7 @@ async def handle_reseller_manage_id_message(update: Update, context: ContextType
     msg = (f"👤 Manage Reseller: @{username} (ID: {target_user_id})\n\n"
            f"Current Status: {current_status_text}")
 
-    keyboard = []
-    if is_reseller:
-        keyboard.append([InlineKeyboardButton("🚫 Disable Reseller Status", callback_data=f"reseller_toggle_status|{target_user_id}|0")]) # Offset 0 as placeholder
-    else:
-        keyboard.append([InlineKeyboardButton("✅ Enable Reseller Status", callback_data=f"reseller_toggle_status|{target_user_id}|0")]) # Offset 0 as placeholder
-
-    keyboard.append([InlineKeyboardButton("⬅️ Manage Another User", callback_data="manage_resellers_menu")]) # Back to the prompt
-    keyboard.append([InlineKeyboardButton("⬅️ Back to Admin Menu", callback_data="admin_menu")])
-
-    await send_message_with_retry(context.bot, chat_id, msg, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=None)
+    await send_message_with_retry(context.bot, chat_id, msg, reply_markup=_build_toggle_kb(target_user_id, is_reseller), parse_mode=None)
 
 
 async def handle_reseller_toggle_status(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
@@ -151,28 +237,22 @@ async def handle_reseller_toggle_status(update: Update, context: ContextTypes.DE
     admin_id = query.from_user.id
     chat_id = query.message.chat_id # Get chat_id for sending messages
 
-    if admin_id != ADMIN_ID: return await query.answer("Access Denied.", show_alert=True)
+    if admin_id != ADMIN_ID: return _answer_in_background(query, "Access Denied.")
     # Params now only need target user ID, offset is irrelevant here
     if not params or not params[0].isdigit():
-        await query.answer("Error: Invalid data.", show_alert=True); return
+        _answer_in_background(query, "Error: Invalid data."); return
 
     target_user_id = int(params[0])
-    conn = None
     try:
-        conn = get_db_connection()
-        c = conn.cursor()
-        c.execute("SELECT username, is_reseller FROM users WHERE user_id = ?", (target_user_id,))
-        user_data = c.fetchone()
+        user_data = await asyncio.to_thread(_toggle_reseller_sync, target_user_id)
         if not user_data:
             await query.answer("User not found.", show_alert=True)
             # Go back to the prompt to enter another ID
             return await handle_manage_resellers_menu(update, context)
-
-        current_status = user_data['is_reseller']
+        invalidate_reseller_discounts(target_user_id)
+        new_status = user_data['is_reseller']
+        current_status = 1 - new_status
         username = user_data['username'] or f"ID_{target_user_id}"
-        new_status = 0 if current_status == 1 else 1
-        c.execute("UPDATE users SET is_reseller = ? WHERE user_id = ?", (new_status, target_user_id))
-        conn.commit()
 
         # Log action using constants from utils
         action_desc = ACTION_RESELLER_ENABLED if new_status == 1 else ACTION_RESELLER_DISABLED
@@ -186,16 +266,7 @@ async def handle_reseller_toggle_status(update: Update, context: ContextTypes.DE
         msg = (f"👤 Manage Reseller: @{username} (ID: {target_user_id})\n\n"
                f"Status Updated: {new_status_text}")
 
-        keyboard = []
-        if new_status == 1: # Now a reseller
-            keyboard.append([InlineKeyboardButton("🚫 Disable Reseller Status", callback_data=f"reseller_toggle_status|{target_user_id}|0")])
-        else: # Not a reseller
-            keyboard.append([InlineKeyboardButton("✅ Enable Reseller Status", callback_data=f"reseller_toggle_status|{target_user_id}|0")])
-
-        keyboard.append([InlineKeyboardButton("⬅️ Manage Another User", callback_data="manage_resellers_menu")])
-        keyboard.append([InlineKeyboardButton("⬅️ Back to Admin Menu", callback_data="admin_menu")])
-
-        await query.edit_message_text(msg, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=None)
+        await query.edit_message_text(msg, reply_markup=_build_toggle_kb(target_user_id, new_status == 1), parse_mode=None)
 
 
     except sqlite3.Error as e:
@@ -204,8 +275,6 @@ async def handle_reseller_toggle_status(update: Update, context: ContextTypes.DE
     except Exception as e:
         logger.error(f"Error toggling reseller status {target_user_id}: {e}", exc_info=True)
         await query.answer("Error.", show_alert=True)
-    finally:
-        if conn: conn.close()
 
 
 # ========================================
@@ -215,47 +284,39 @@ async def handle_reseller_toggle_status(update: Update, context: ContextTypes.DE
 async def handle_manage_reseller_discounts_select_reseller(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Admin selects which active reseller to manage discounts for (PAGINATED)."""
     query = update.callback_query
-    if query.from_user.id != ADMIN_ID: return await query.answer("Access Denied.", show_alert=True)
-    offset = 0
-    if params and len(params) > 0 and params[0].isdigit(): offset = int(params[0])
+    if query.from_user.id != ADMIN_ID: return _answer_in_background(query, "Access Denied.")
+    cursor = None # ('n', last user_id shown) for Next, ('p', first user_id shown) for Prev; '|0' means the first page
+    if params and params[-1][:1] in ('n', 'p') and params[-1][1:].isdigit(): cursor = (params[-1][0], int(params[-1][1:]))
 
     resellers = []
+    rows_before = 0
     total_resellers = 0
-    conn = None
     try:
-        conn = get_db_connection()
-        c = conn.cursor()
-        c.execute("SELECT COUNT(*) as count FROM users WHERE is_reseller = 1")
-        count_res = c.fetchone(); total_resellers = count_res['count'] if count_res else 0
-        c.execute("""
-            SELECT user_id, username FROM users
-            WHERE is_reseller = 1 ORDER BY user_id DESC LIMIT ? OFFSET ?
-        """, (USERS_PER_PAGE_DISCOUNT_SELECT, offset)) # Use specific constant
-        resellers = c.fetchall()
+        resellers, rows_before = await asyncio.to_thread(_fetch_reseller_page_sync, cursor)
+        total_resellers = resellers[0]['total'] if resellers else 0 # Only needed when the page has rows
     except sqlite3.Error as e:
         logger.error(f"DB error fetching active resellers: {e}")
         await query.edit_message_text("❌ DB Error fetching resellers.", parse_mode=None)
         return
-    finally:
-        if conn: conn.close()
 
     msg = "👤 Manage Reseller Discounts\n\nSelect an active reseller to set their discounts:\n"
     keyboard = []
     item_buttons = []
 
-    if not resellers and offset == 0: msg += "\nNo active resellers found."
+    if not resellers and cursor is None: msg += "\nNo active resellers found."
     elif not resellers: msg += "\nNo more resellers."
     else:
         for r in resellers:
             username = r['username'] or f"ID_{r['user_id']}"
             item_buttons.append([InlineKeyboardButton(f"👤 @{username}", callback_data=f"reseller_manage_specific|{r['user_id']}")])
         keyboard.extend(item_buttons)
-        # Pagination
-        total_pages = math.ceil(max(0, total_resellers) / USERS_PER_PAGE_DISCOUNT_SELECT)
-        current_page = (offset // USERS_PER_PAGE_DISCOUNT_SELECT) + 1
+        # Pagination: pages are counted around the rows actually shown, so the label matches what Prev/Next will show
+        rows_after = max(0, total_resellers - rows_before - len(resellers))
+        current_page = math.ceil(rows_before / USERS_PER_PAGE_DISCOUNT_SELECT) + 1
+        total_pages = current_page + math.ceil(rows_after / USERS_PER_PAGE_DISCOUNT_SELECT)
         nav_buttons = []
-        if current_page > 1: nav_buttons.append(InlineKeyboardButton("⬅️ Prev", callback_data=f"manage_reseller_discounts_select_reseller|{max(0, offset - USERS_PER_PAGE_DISCOUNT_SELECT)}"))
-        if current_page < total_pages: nav_buttons.append(InlineKeyboardButton("Next ➡️", callback_data=f"manage_reseller_discounts_select_reseller|{offset + USERS_PER_PAGE_DISCOUNT_SELECT}"))
+        if rows_before > 0: nav_buttons.append(InlineKeyboardButton("⬅️ Prev", callback_data=f"manage_reseller_discounts_select_reseller|p{resellers[0]['user_id']}"))
+        if rows_after > 0: nav_buttons.append(InlineKeyboardButton("Next ➡️", callback_data=f"manage_reseller_discounts_select_reseller|n{resellers[-1]['user_id']}"))
         if nav_buttons: keyboard.append(nav_buttons)
         msg += f"\nPage {current_page}/{total_pages}"
 
@@ -278,30 +339,20 @@ async def handle_manage_specific_reseller_discounts(update: Update, context: Con
     """Displays current discounts for a specific reseller and allows adding/editing."""
     query = update.callback_query
     admin_id = query.from_user.id
-    if admin_id != ADMIN_ID: return await query.answer("Access Denied.", show_alert=True)
+    if admin_id != ADMIN_ID: return _answer_in_background(query, "Access Denied.")
     if not params or not params[0].isdigit():
-        await query.answer("Error: Invalid user ID.", show_alert=True); return
+        _answer_in_background(query, "Error: Invalid user ID."); return
 
     target_reseller_id = int(params[0])
     discounts = []
     username = f"ID_{target_reseller_id}"
-    conn = None
     try:
-        conn = get_db_connection()
-        c = conn.cursor()
-        c.execute("SELECT username FROM users WHERE user_id = ?", (target_reseller_id,))
-        user_res = c.fetchone(); username = user_res['username'] if user_res and user_res['username'] else username
-        c.execute("""
-            SELECT product_type, discount_percentage FROM reseller_discounts
-            WHERE reseller_user_id = ? ORDER BY product_type
-        """, (target_reseller_id,))
-        discounts = c.fetchall()
+        db_username, discounts = await asyncio.to_thread(_fetch_reseller_discounts_sync, target_reseller_id)
+        username = db_username or username
     except sqlite3.Error as e:
         logger.error(f"DB error fetching discounts for reseller {target_reseller_id}: {e}")
         await query.edit_message_text("❌ DB Error fetching discounts.", parse_mode=None)
         return
-    finally:
-        if conn: conn.close()
 
     msg = f"🏷️ Discounts for Reseller @{username} (ID: {target_reseller_id})\n\n"
     keyboard = []
@@ -311,8 +362,8 @@ async def handle_manage_specific_reseller_discounts(update: Update, context: Con
         msg += "Current Discounts:\n"
         for discount in discounts:
             p_type = discount['product_type']
-            emoji = PRODUCT_TYPES.get(p_type, DEFAULT_PRODUCT_EMOJI)
-            percentage = Decimal(str(discount['discount_percentage']))
+            emoji = discount['emoji']
+            percentage = _bp_to_percent(discount['discount_bp'])
             msg += f" • {emoji} {p_type}: {percentage:.1f}%\n"
             keyboard.append([
                  InlineKeyboardButton(f"✏️ Edit {p_type} ({percentage:.1f}%)", callback_data=f"reseller_edit_discount|{target_reseller_id}|{p_type}"),
@@ -334,36 +385,42 @@ async def handle_manage_specific_reseller_discounts(update: Update, context: Con
         await query.edit_message_text("❌ Error displaying discounts.", parse_mode=None)
 
 
+@lru_cache(maxsize=64)
+def _discount_type_keyboard(product_types_version: int, target_reseller_id: int) -> InlineKeyboardMarkup:
+    """Product type picker for one reseller. The version argument only keys the cache, so edits to PRODUCT_TYPES rebuild it."""
+    keyboard = []
+    for type_name, emoji in sorted(PRODUCT_TYPES.items()):
+        keyboard.append([InlineKeyboardButton(f"{emoji} {type_name}", callback_data=f"reseller_add_discount_enter_percent|{target_reseller_id}|{type_name}")])
+
+    keyboard.append([InlineKeyboardButton("❌ Cancel", callback_data=f"reseller_manage_specific|{target_reseller_id}")])
+    return InlineKeyboardMarkup(keyboard)
+
 async def handle_reseller_add_discount_select_type(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Admin selects product type for a new reseller discount rule."""
     query = update.callback_query
     admin_id = query.from_user.id
-    if admin_id != ADMIN_ID: return await query.answer("Access Denied.", show_alert=True)
+    if admin_id != ADMIN_ID: return _answer_in_background(query, "Access Denied.")
     if not params or not params[0].isdigit():
-        await query.answer("Error: Invalid user ID.", show_alert=True); return
+        _answer_in_background(query, "Error: Invalid user ID."); return
 
     target_reseller_id = int(params[0])
-    load_all_data() # Ensure PRODUCT_TYPES is fresh
+    get_product_types_cached() # Reloads only product types, and only when stale
 
     if not PRODUCT_TYPES:
         await query.edit_message_text("❌ No product types configured. Please add types via 'Manage Product Types'.", parse_mode=None)
         return
 
-    keyboard = []
-    for type_name, emoji in sorted(PRODUCT_TYPES.items()):
-        keyboard.append([InlineKeyboardButton(f"{emoji} {type_name}", callback_data=f"reseller_add_discount_enter_percent|{target_reseller_id}|{type_name}")])
-
-    keyboard.append([InlineKeyboardButton("❌ Cancel", callback_data=f"reseller_manage_specific|{target_reseller_id}")])
-    await query.edit_message_text("Select Product Type for new discount rule:", reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=None)
+    reply_markup = _discount_type_keyboard(get_product_types_version(), target_reseller_id)
+    await query.edit_message_text("Select Product Type for new discount rule:", reply_markup=reply_markup, parse_mode=None)
 
 
 async def handle_reseller_add_discount_enter_percent(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Admin needs to enter the percentage for the new rule."""
     query = update.callback_query
     admin_id = query.from_user.id
-    if admin_id != ADMIN_ID: return await query.answer("Access Denied.", show_alert=True)
+    if admin_id != ADMIN_ID: return _answer_in_background(query, "Access Denied.")
     if not params or len(params) < 2 or not params[0].isdigit():
-        await query.answer("Error: Invalid data.", show_alert=True); return
+        _answer_in_background(query, "Error: Invalid data."); return
 
     target_reseller_id = int(params[0])
     product_type = params[1]
@@ -386,9 +443,9 @@ async def handle_reseller_edit_discount(update: Update, context: ContextTypes.DE
     """Admin wants to edit an existing discount percentage."""
     query = update.callback_query
     admin_id = query.from_user.id
-    if admin_id != ADMIN_ID: return await query.answer("Access Denied.", show_alert=True)
+    if admin_id != ADMIN_ID: return _answer_in_background(query, "Access Denied.")
     if not params or len(params) < 2 or not params[0].isdigit():
-        await query.answer("Error: Invalid data.", show_alert=True); return
+        _answer_in_background(query, "Error: Invalid data."); return
 
     target_reseller_id = int(params[0])
     product_type = params[1]
@@ -407,6 +464,11 @@ async def handle_reseller_edit_discount(update: Update, context: ContextTypes.DE
     await query.answer("Enter new percentage in chat.")
 
 
+_RESELLER_STATE_KEYS = ('state', 'reseller_mgmt_target_id', 'reseller_mgmt_product_type', 'reseller_mgmt_mode')
+
+def _clear_reseller_mgmt_state(context: ContextTypes.DEFAULT_TYPE):
+    for key in _RESELLER_STATE_KEYS: context.user_data.pop(key, None)
+
 async def handle_reseller_percent_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handles the admin entering the discount percentage via message."""
     admin_id = update.effective_user.id
@@ -422,62 +484,43 @@ async def handle_reseller_percent_message(update: Update, context: ContextTypes.
 
     if target_user_id is None or not product_type:
         logger.error("State awaiting_reseller_discount_percent missing context data.")
-        await send_message_with_retry(context.bot, chat_id, "❌ Error: Context lost. Please start again.", parse_mode=None)
-        context.user_data.pop('state', None)
+        _clear_reseller_mgmt_state(context)
         fallback_cb = "manage_reseller_discounts_select_reseller|0"
-        await send_message_with_retry(context.bot, chat_id, "Returning...", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Back", callback_data=fallback_cb)]]), parse_mode=None)
+        await send_message_with_retry(context.bot, chat_id, "❌ Error: Context lost. Please start again.\n\nReturning...", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Back", callback_data=fallback_cb)]]), parse_mode=None)
         return
 
     back_callback = f"reseller_manage_specific|{target_user_id}"
 
     try:
         percentage = Decimal(percent_text)
-        if not (Decimal('0.0') <= percentage <= Decimal('100.0')):
+        if not (_ZERO_DISCOUNT <= percentage <= _HUNDRED_PERCENT):
             raise ValueError("Percentage must be between 0 and 100.")
+        discount_bp = int((percentage * 100).to_integral_value(rounding=ROUND_HALF_UP)) # Stored precision: 0.01%
+        percentage = _bp_to_percent(discount_bp)
 
-        conn = None
-        old_value = None # For logging edits
         try:
-            conn = get_db_connection()
-            c = conn.cursor()
-            c.execute("BEGIN")
-
-            if mode == 'edit':
-                c.execute("SELECT discount_percentage FROM reseller_discounts WHERE reseller_user_id = ? AND product_type = ?", (target_user_id, product_type))
-                old_res = c.fetchone()
-                old_value = old_res['discount_percentage'] if old_res else None
-
-            # Use INSERT OR REPLACE for both add and edit to simplify logic
-            # If it's an 'edit' but the row doesn't exist, it becomes an 'add'
-            sql = "INSERT OR REPLACE INTO reseller_discounts (reseller_user_id, product_type, discount_percentage) VALUES (?, ?, ?)"
-            params_sql = (target_user_id, product_type, float(percentage))
+            old_value = await asyncio.to_thread(_save_reseller_discount_sync, target_user_id, product_type, discount_bp, mode) # For logging edits
+            invalidate_reseller_discounts(target_user_id)
 
             # Determine action description based on whether old value existed
             action_desc = ACTION_RESELLER_DISCOUNT_ADD if old_value is None else ACTION_RESELLER_DISCOUNT_EDIT
 
-            result = c.execute(sql, params_sql)
-            conn.commit()
-
             # Log the action
             log_admin_action(
                 admin_id=admin_id, action=action_desc, target_user_id=target_user_id,
-                reason=f"Type: {product_type}", old_value=old_value, new_value=float(percentage)
+                reason=f"Type: {product_type}", old_value=old_value, new_value=discount_bp / 100
             )
 
             action_verb = "set" if old_value is None else "updated"
             await send_message_with_retry(context.bot, chat_id, f"✅ Discount rule {action_verb} for {product_type}: {percentage:.1f}%",
                                         reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Back", callback_data=back_callback)]]), parse_mode=None)
 
-            context.user_data.pop('state', None); context.user_data.pop('reseller_mgmt_target_id', None)
-            context.user_data.pop('reseller_mgmt_product_type', None); context.user_data.pop('reseller_mgmt_mode', None)
+            _clear_reseller_mgmt_state(context)
 
         except sqlite3.Error as e: # Catch potential DB errors like IntegrityError implicitly
             logger.error(f"DB error {mode} reseller discount: {e}", exc_info=True)
-            if conn and conn.in_transaction: conn.rollback()
             await send_message_with_retry(context.bot, chat_id, "❌ DB Error saving discount rule.", parse_mode=None)
-            context.user_data.pop('state', None) # Clear state on error
-        finally:
-            if conn: conn.close()
+            _clear_reseller_mgmt_state(context) # Clear state on error
 
     except ValueError:
         await send_message_with_retry(context.bot, chat_id, "❌ Invalid percentage. Enter a number between 0 and 100 (e.g., 10 or 15.5).", parse_mode=None)
@@ -488,9 +531,9 @@ async def handle_reseller_delete_discount_confirm(update: Update, context: Conte
     """Handles 'Delete Discount' button press, shows confirmation."""
     query = update.callback_query
     admin_id = query.from_user.id
-    if admin_id != ADMIN_ID: return await query.answer("Access Denied.", show_alert=True)
+    if admin_id != ADMIN_ID: return _answer_in_background(query, "Access Denied.")
     if not params or len(params) < 2 or not params[0].isdigit():
-        await query.answer("Error: Invalid data.", show_alert=True); return
+        _answer_in_background(query, "Error: Invalid data."); return
 
     target_reseller_id = int(params[0])
     product_type = params[1]
@@ -25,7 +25,9 @@ from utils import (
     DEFAULT_PRODUCT_EMOJI, # Import default emoji
     load_active_welcome_message, # <<< Import welcome message loader (though we'll modify its usage)
     DEFAULT_WELCOME_MESSAGE, # <<< Import default welcome message fallback
-    _get_lang_data # <<< IMPORT THE HELPER FROM UTILS >>>
+    _get_lang_data, # <<< IMPORT THE HELPER FROM UTILS >>>
+    clear_payment_ctx, REFILL_CTX_KEYS, BASKET_PAY_CTX_KEYS,
+    set_cached_user_lang, invalidate_user_lang
 )
 import json # <<< Make sure json is imported
 import payment # <<< Make sure payment module is imported
@@ -73,27 +75,34 @@ def _build_start_menu_content(user_id: int, username: str, lang_data: dict, cont
     balance, purchases, basket_count = Decimal('0.0'), 0, 0
     conn = None
     active_template_name_from_db = None # Variable to store DB setting
+    welcome_template_to_use = None # Start with None
 
-    # --- Initial Data Fetch ---
+    # --- Initial Data Fetch (user stats + active welcome template in one query) ---
     try:
         conn = get_db_connection()
         c = conn.cursor()
-        # Get user stats
-        c.execute("SELECT balance, total_purchases FROM users WHERE user_id = ?", (user_id,))
+        # Always returns one row: user columns are NULL for unknown users, tmpl_text is NULL if the template is missing
+        c.execute("""
+            WITH active AS (
+                SELECT COALESCE(NULLIF((SELECT setting_value FROM bot_settings WHERE setting_key = ?), ''), 'default') AS tmpl_name
+            )
+            SELECT u.user_id IS NOT NULL AS has_user, u.balance, u.total_purchases,
+                   active.tmpl_name, wm.template_text AS tmpl_text
+            FROM active
+            LEFT JOIN users u ON u.user_id = ?
+            LEFT JOIN welcome_messages wm ON wm.name = active.tmpl_name
+        """, ("active_welcome_message_name", user_id))
         result = c.fetchone()
-        if result:
+        if result['has_user']:
             balance = Decimal(str(result['balance']))
             purchases = result['total_purchases']
 
-        # Get active welcome template name setting
-        c.execute("SELECT setting_value FROM bot_settings WHERE setting_key = ?", ("active_welcome_message_name",)) # LINE 89
-        setting_row = c.fetchone()
-        if setting_row and setting_row['setting_value']: # Check if value is not None/empty
-            active_template_name_from_db = setting_row['setting_value']
-            logger.info(f"Active welcome template name from settings: '{active_template_name_from_db}'")
+        active_template_name_from_db = result['tmpl_name'] # 'default' if the setting is missing/empty
+        welcome_template_to_use = result['tmpl_text']
+        if welcome_template_to_use is not None:
+            logger.info(f"Using welcome message template from DB: '{active_template_name_from_db}'")
         else:
-            active_template_name_from_db = "default" # Fallback to 'default' if setting is missing/empty
-            logger.info("Active welcome message name not found in settings, falling back to 'default'.")
+            logger.warning(f"Active template '{active_template_name_from_db}' set in DB but not found in templates table. Will fall back.")
 
         clear_expired_basket(context, user_id)
         basket = context.user_data.get("basket", [])
@@ -102,32 +111,9 @@ def _build_start_menu_content(user_id: int, username: str, lang_data: dict, cont
 
     except sqlite3.Error as e:
         logger.error(f"Database error fetching initial data for start menu build (user {user_id}): {e}", exc_info=True)
-        active_template_name_from_db = "default" # Fallback on DB error fetching setting
     finally:
         if conn: conn.close()
 
-    # --- Determine which template text to use ---
-    welcome_template_to_use = None # Start with None
-
-    if active_template_name_from_db: # Only try if we have a name (even if it's 'default')
-        conn_load = None
-        try:
-            conn_load = get_db_connection()
-            c_load = conn_load.cursor()
-            c_load.execute("SELECT template_text FROM welcome_messages WHERE name = ?", (active_template_name_from_db,))
-            template_row = c_load.fetchone()
-            if template_row:
-                welcome_template_to_use = template_row['template_text']
-                logger.info(f"Using welcome message template from DB: '{active_template_name_from_db}'")
-            else:
-                logger.warning(f"Active template '{active_template_name_from_db}' set in DB but not found in templates table. Will fall back.")
-                # welcome_template_to_use remains None
-        except sqlite3.Error as e:
-            logger.error(f"DB error loading specific welcome template '{active_template_name_from_db}': {e}")
-            # welcome_template_to_use remains None
-        finally:
-            if conn_load: conn_load.close()
-
     # Fallback logic if DB load failed or no active name was determined initially
     if welcome_template_to_use is None:
         logger.warning("Falling back to default welcome message defined in LANGUAGES.")
@@ -239,6 +225,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
             lang = db_lang if db_lang and db_lang in UTILS_LANGUAGES_START else 'en'
             conn.commit()
             context.user_data["lang"] = lang # Store in context
+            set_cached_user_lang(user_id, lang) # Seed the webhook-side language cache
             logger.info(f"start: Set language for user {user_id} to '{lang}' from DB/default.")
         except sqlite3.Error as e:
             logger.error(f"DB error ensuring user/language in start for {user_id}: {e}")
@@ -1500,9 +1487,7 @@ async def handle_basket_discount_code_message(update: Update, context: ContextTy
         logger.error(f"User {user_id} sent basket discount code but snapshot/total context is missing.")
         await send_message_with_retry(context.bot, chat_id, "Error: Context lost. Returning to basket.", parse_mode=None)
         # Clean up potentially stale context
-        context.user_data.pop('basket_pay_snapshot', None)
-        context.user_data.pop('basket_pay_total_eur', None)
-        context.user_data.pop('basket_pay_discount_code', None)
+        clear_payment_ctx(context, BASKET_PAY_CTX_KEYS) # 'state' was already cleared above
         return await handle_view_basket(update, context) # Send back to basket
 
     if not entered_code:
@@ -1679,6 +1664,7 @@ async def handle_language_selection(update: Update, context: ContextTypes.DEFAUL
                 c = conn.cursor()
                 c.execute("UPDATE users SET language = ? WHERE user_id = ?", (new_lang, user_id))
                 conn.commit()
+                set_cached_user_lang(user_id, new_lang) # Keep payment notifications in the new language
                 logger.info(f"User {user_id} DB language updated to {new_lang}")
 
                 context.user_data["lang"] = new_lang
@@ -1698,6 +1684,7 @@ async def handle_language_selection(update: Update, context: ContextTypes.DEFAUL
 
             except sqlite3.Error as e:
                 logger.error(f"DB error updating language user {user_id}: {e}");
+                invalidate_user_lang(user_id) # Unknown DB state: re-read on next use
                 if conn and conn.in_transaction: conn.rollback()
                 error_saving_lang = current_lang_data.get("error_saving_language", "Error saving.")
                 await query.answer(error_saving_lang, show_alert=True)
@@ -2014,7 +2001,7 @@ async def handle_refill_amount_message(update: Update, context: ContextTypes.DEF
             await send_message_with_retry(context.bot, chat_id, f"❌ {amount_too_high_msg}", parse_mode=None)
             return
 
-        context.user_data['refill_eur_amount'] = float(refill_amount_decimal)
+        context.user_data['refill_eur_amount'] = refill_amount_decimal # Keep as Decimal, avoids float round-trip in payment
         context.user_data['state'] = 'awaiting_refill_crypto_choice' # State remains specific to refill
         logger.info(f"User {user_id} entered refill EUR: {refill_amount_decimal:.2f}. State -> awaiting_refill_crypto_choice")
 
@@ -2045,8 +2032,7 @@ async def handle_refill_amount_message(update: Update, context: ContextTypes.DEF
     except Exception as e:
         logger.error(f"Error processing refill amount user {user_id}: {e}", exc_info=True)
         await send_message_with_retry(context.bot, chat_id, f"❌ {unexpected_error_msg}", parse_mode=None)
-        context.user_data.pop('state', None)
-        context.user_data.pop('refill_eur_amount', None)
+        clear_payment_ctx(context, REFILL_CTX_KEYS)
 
 
 # <<< NEW Handler for Pay Single Item Button >>>
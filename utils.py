@@ -6,10 +6,14 @@ import json
 import shutil
 import tempfile
 import asyncio
+import queue
+import random
+import threading
+from contextlib import contextmanager
 from datetime import datetime, timedelta, timezone
-from decimal import Decimal, ROUND_DOWN, ROUND_UP
+from decimal import Decimal, Context, InvalidOperation, ROUND_DOWN, ROUND_UP, ROUND_HALF_EVEN
 import requests
-from collections import Counter, defaultdict # Moved higher up
+from collections import Counter, OrderedDict, defaultdict # Moved higher up
 
 # --- Telegram Imports ---
 from telegram import Update, Bot
@@ -50,6 +54,7 @@ ADMIN_ID_RAW = os.environ.get("ADMIN_ID", None)
 SECONDARY_ADMIN_IDS_STR = os.environ.get("SECONDARY_ADMIN_IDS", "")
 SUPPORT_USERNAME = os.environ.get("SUPPORT_USERNAME", "support")
 BASKET_TIMEOUT_MINUTES_STR = os.environ.get("BASKET_TIMEOUT_MINUTES", "15")
+PAYMENT_TRACE_ERRORS = os.environ.get("PAYMENT_TRACE_ERRORS", "0") == "1" # Full tracebacks for expected payment API/DB errors
 
 ADMIN_ID = None
 if ADMIN_ID_RAW is not None:
@@ -866,10 +871,21 @@ DEFAULT_PRODUCT_EMOJI = "💎" # Fallback emoji
 SIZES = ["2g", "5g"]
 BOT_MEDIA = {'type': None, 'path': None}
 currency_price_cache = {}
-min_amount_cache = {}
+min_amount_cache = {} # currency (lower) -> (Decimal | None, time.monotonic() fetched); None marks a failed lookup
 CACHE_EXPIRY_SECONDS = 900
+MIN_AMOUNT_NEGATIVE_TTL_SECONDS = 30 # Failed lookups are retried after this, so error storms don't hammer the API
 
 # --- Database Connection Helper ---
+DB_MMAP_SIZE = 256 * 1024 * 1024 # Reads are served from the OS page cache instead of copied into SQLite's
+
+def _apply_connection_pragmas(conn: sqlite3.Connection):
+    conn.execute("PRAGMA foreign_keys = ON;")
+    journal_mode = conn.execute("PRAGMA journal_mode = WAL;").fetchone()[0] # Readers don't block the writer
+    if journal_mode.lower() != 'wal': logger.warning(f"SQLite journal_mode is '{journal_mode}', not WAL, for {DATABASE_PATH}.")
+    conn.execute("PRAGMA synchronous = NORMAL;") # No fsync per commit in WAL mode; still durable against app crashes
+    conn.execute(f"PRAGMA mmap_size = {DB_MMAP_SIZE};")
+    conn.execute("PRAGMA temp_store = MEMORY;") # Sorts/temp indices for IN (...) lookups stay off disk
+
 def get_db_connection():
     """Returns a connection to the SQLite database using the configured path."""
     try:
@@ -878,7 +894,7 @@ def get_db_connection():
             try: os.makedirs(db_dir, exist_ok=True)
             except OSError as e: logger.warning(f"Could not create DB dir {db_dir}: {e}")
         conn = sqlite3.connect(DATABASE_PATH, timeout=10)
-        conn.execute("PRAGMA foreign_keys = ON;")
+        _apply_connection_pragmas(conn)
         conn.row_factory = sqlite3.Row
         return conn
     except sqlite3.Error as e:
@@ -886,9 +902,43 @@ def get_db_connection():
         raise SystemExit(f"Failed to connect to database: {e}")
 
 
+# --- Pooled Database Connections (long-lived, WAL mode) ---
+DB_POOL_SIZE = 4 # Idle connections kept open for reuse
+DB_STATEMENT_CACHE_SIZE = 256 # Prepared statements kept per pooled connection (sqlite3 default: 128)
+_db_pool: queue.SimpleQueue = queue.SimpleQueue() # Thread-safe, so connections can be used from asyncio.to_thread
+
+def _create_pooled_connection() -> sqlite3.Connection:
+    # Long-lived connections keep their prepared statements, so repeated SQL skips sqlite3_prepare
+    conn = sqlite3.connect(DATABASE_PATH, timeout=10, check_same_thread=False, cached_statements=DB_STATEMENT_CACHE_SIZE)
+    _apply_connection_pragmas(conn)
+    conn.execute("PRAGMA cache_size = -65536;") # ~64MB page cache, kept warm across checkouts
+    conn.row_factory = sqlite3.Row
+    return conn
+
+@contextmanager
+def pooled_db_connection():
+    """
+    Checks out a long-lived connection from the pool (opening a new one if none is idle)
+    and returns it afterwards. Any transaction left open is rolled back on return.
+    Raises sqlite3.Error on connection failure, unlike get_db_connection.
+    """
+    try: conn = _db_pool.get_nowait()
+    except queue.Empty: conn = _create_pooled_connection()
+    try:
+        yield conn
+    finally:
+        if conn.in_transaction: conn.rollback()
+        if _db_pool.qsize() < DB_POOL_SIZE: _db_pool.put(conn)
+        else: conn.close()
+
+
 # --- Database Initialization ---
 def init_db():
     """Initializes the database schema."""
+    # UPDATE ... RETURNING (balances, refills, stock, reseller toggle) needs SQLite 3.35+
+    if sqlite3.sqlite_version_info < (3, 35, 0):
+        logger.critical(f"SQLite {sqlite3.sqlite_version} is too old; 3.35.0 or newer is required.")
+        raise SystemExit(f"SQLite {sqlite3.sqlite_version} is too old; 3.35.0 or newer is required.")
     try:
         with get_db_connection() as conn:
             c = conn.cursor()
@@ -984,6 +1034,11 @@ def init_db():
             if 'basket_snapshot_json' not in pending_cols: c.execute("ALTER TABLE pending_deposits ADD COLUMN basket_snapshot_json TEXT DEFAULT NULL")
             if 'discount_code_used' not in pending_cols: c.execute("ALTER TABLE pending_deposits ADD COLUMN discount_code_used TEXT DEFAULT NULL")
 
+            # processed_payments table (refill idempotency - a payment_id is credited at most once)
+            c.execute('''CREATE TABLE IF NOT EXISTS processed_payments (
+                payment_id TEXT PRIMARY KEY NOT NULL, processed_at TEXT NOT NULL
+            )''')
+
             # Admin Log table
             c.execute('''CREATE TABLE IF NOT EXISTS admin_log (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -1013,6 +1068,10 @@ def init_db():
                 FOREIGN KEY (reseller_user_id) REFERENCES users(user_id) ON DELETE CASCADE,
                 FOREIGN KEY (product_type) REFERENCES product_types(name) ON DELETE CASCADE
             )''')
+            # Discounts are read as integer basis points (15.5% -> 1550); discount_percentage is still written for older readers
+            reseller_discount_cols = [col[1] for col in c.execute("PRAGMA table_info(reseller_discounts)").fetchall()]
+            if 'discount_bp' not in reseller_discount_cols: c.execute("ALTER TABLE reseller_discounts ADD COLUMN discount_bp INTEGER")
+            c.execute("UPDATE reseller_discounts SET discount_bp = CAST(ROUND(discount_percentage * 100) AS INTEGER) WHERE discount_bp IS NULL")
             # <<< END ADDED >>>
 
             # Insert initial welcome messages (only if table was just created or empty - handled by INSERT OR IGNORE)
@@ -1225,13 +1284,33 @@ def load_all_data():
 
         CITIES.clear(); CITIES.update(cities_data)
         DISTRICTS.clear(); DISTRICTS.update(districts_data)
-        PRODUCT_TYPES.clear(); PRODUCT_TYPES.update(product_types_dict)
+        _replace_product_types(product_types_dict)
 
         logger.info(f"Loaded (in-place) {len(CITIES)} cities, {sum(len(d) for d in DISTRICTS.values())} districts, {len(PRODUCT_TYPES)} product types.")
     except Exception as e:
         logger.error(f"Error during load_all_data (in-place): {e}", exc_info=True)
         CITIES.clear(); DISTRICTS.clear(); PRODUCT_TYPES.clear()
 
+# Admin product type edits already call load_all_data; the TTL only bounds staleness from outside changes
+PRODUCT_TYPES_CACHE_TTL_SECONDS = 30
+_product_types_loaded_at = 0.0 # time.monotonic() of the last PRODUCT_TYPES load
+_product_types_version = 0 # Bumped whenever PRODUCT_TYPES contents change; lets callers key caches on it
+
+def _replace_product_types(product_types_dict: dict):
+    global _product_types_loaded_at, _product_types_version
+    if product_types_dict != PRODUCT_TYPES:
+        PRODUCT_TYPES.clear(); PRODUCT_TYPES.update(product_types_dict)
+        _product_types_version += 1
+    _product_types_loaded_at = time.monotonic()
+
+def get_product_types_version() -> int:
+    return _product_types_version
+
+def get_product_types_cached(ttl: float = PRODUCT_TYPES_CACHE_TTL_SECONDS) -> dict:
+    """Returns PRODUCT_TYPES, reloading just that table (in place) if it is older than ttl seconds."""
+    if time.monotonic() - _product_types_loaded_at >= ttl: _replace_product_types(load_product_types())
+    return PRODUCT_TYPES
+
 
 # --- Bot Media Loading (from specified path on disk) ---
 if os.path.exists(BOT_MEDIA_JSON_PATH):
@@ -1256,9 +1335,65 @@ def _get_lang_data(context: ContextTypes.DEFAULT_TYPE) -> tuple[str, dict]:
         lang = 'en' # Ensure lang variable reflects the fallback
     return lang, lang_data
 
+# --- User Language Cache ---
+USER_LANG_CACHE_MAX = 4096
+USER_LANG_CACHE_TTL_SECONDS = 300 # Bounds staleness if the DB is changed outside set_cached_user_lang
+_user_lang_cache: OrderedDict[int, tuple[str, float]] = OrderedDict() # user_id -> (lang, time.monotonic() stored), LRU order
+_user_lang_cache_lock = threading.Lock() # Used from the event loop, worker threads and the Flask webhook thread
+
+def set_cached_user_lang(user_id: int, lang: str):
+    """Records a user's language, e.g. right after it was read from or written to the DB."""
+    with _user_lang_cache_lock:
+        _user_lang_cache[user_id] = (lang, time.monotonic())
+        _user_lang_cache.move_to_end(user_id)
+        if len(_user_lang_cache) > USER_LANG_CACHE_MAX: _user_lang_cache.popitem(last=False)
+
+def invalidate_user_lang(user_id: int):
+    with _user_lang_cache_lock: _user_lang_cache.pop(user_id, None)
+
+def lookup_cached_user_lang(user_id: int) -> str | None:
+    """Returns the cached language for user_id, or None on a miss/expired entry."""
+    with _user_lang_cache_lock:
+        entry = _user_lang_cache.get(user_id)
+        if entry is None or time.monotonic() - entry[1] >= USER_LANG_CACHE_TTL_SECONDS: return None
+        _user_lang_cache.move_to_end(user_id)
+        return entry[0]
+
+def get_user_lang(user_id: int) -> str:
+    """Returns the user's stored language (falls back to 'en'), hitting the DB only on a cache miss. Synchronous."""
+    lang = lookup_cached_user_lang(user_id)
+    if lang is not None: return lang
+    with pooled_db_connection() as conn:
+        row = conn.execute("SELECT language FROM users WHERE user_id = ?", (user_id,)).fetchone()
+    if row is None: return 'en' # Unknown user: don't cache, they may register shortly
+    lang = row['language'] if row['language'] in LANGUAGES else 'en'
+    set_cached_user_lang(user_id, lang)
+    return lang
+
+# --- Payment Context Cleanup ---
+REFILL_CTX_KEYS = ('refill_eur_amount', 'state')
+BASKET_PAY_CTX_KEYS = ('basket_pay_snapshot', 'basket_pay_total_eur', 'basket_pay_discount_code', 'state')
+
+def clear_payment_ctx(context: ContextTypes.DEFAULT_TYPE, keys: tuple[str, ...]):
+    """Removes the given payment-flow keys from user_data in one pass."""
+    user_data = context.user_data
+    for key in keys: user_data.pop(key, None)
+
+# MarkdownV2 special characters (same set as telegram.helpers.escape_markdown(version=2))
+_MDV2_ESCAPE_TABLE = str.maketrans({ch: '\\' + ch for ch in '\\_*[]()~`>#+-=|{}.!'})
+
+def escape_markdown_v2(text: str) -> str:
+    """Escapes text for MarkdownV2 in a single C-level str.translate pass (no regex)."""
+    return text.translate(_MDV2_ESCAPE_TABLE)
+
+_TWOPLACES = Decimal('0.01')
+_EUR_CTX = Context(prec=18, rounding=ROUND_HALF_EVEN) # Dedicated context: no thread-local lookup per call; same rounding as the default context
+
 def format_currency(value):
-    try: return f"{Decimal(str(value)):.2f}"
-    except (ValueError, TypeError): logger.warning(f"Could format currency {value}"); return "0.00"
+    try:
+        if not isinstance(value, Decimal): value = Decimal(str(value))
+        return str(value.quantize(_TWOPLACES, context=_EUR_CTX))
+    except (ValueError, TypeError, InvalidOperation): logger.warning(f"Could format currency {value}"); return "0.00"
 
 def format_discount_value(dtype, value):
     try:
@@ -1312,6 +1447,108 @@ async def send_message_with_retry(
             else: logger.error(f"Max retries reached after unexpected error sending to {chat_id}: {e}"); break
     logger.error(f"Failed to send message to {chat_id} after {max_retries} attempts: {text[:100]}..."); return None
 
+# PTB strips Telegram's "Bad Request: " prefix and capitalizes the rest, so this casing is stable
+MSG_NOT_MODIFIED = "Message is not modified"
+
+# --- Per-Chat Edit Throttle ---
+EDIT_MIN_INTERVAL_SECONDS = 1.1 # Telegram allows roughly one message per second per chat
+_EDIT_BUCKETS_MAX = 1024 # Prune expired entries beyond this many tracked chats
+_edit_buckets: dict[int, float] = {} # chat_id -> earliest time.monotonic() the next edit may go out
+
+async def throttle_chat_edit(chat_id: int):
+    """
+    Waits until chat_id may receive another message edit. The slot is reserved before
+    sleeping, so concurrent callers for the same chat queue up instead of bursting.
+    Chats without a recent edit go through immediately.
+    """
+    now = time.monotonic()
+    send_at = max(now, _edit_buckets.get(chat_id, 0.0))
+    _edit_buckets[chat_id] = send_at + EDIT_MIN_INTERVAL_SECONDS
+    if len(_edit_buckets) > _EDIT_BUCKETS_MAX:
+        for stale_chat_id in [cid for cid, ts in _edit_buckets.items() if ts <= now]: del _edit_buckets[stale_chat_id]
+    if send_at > now: await asyncio.sleep(send_at - now)
+
+async def tg_call_with_retry(coro_factory, max_attempts: int = 5, max_backoff: float = 15.0, chat_id: int | None = None):
+    """
+    Runs a Telegram API call built by coro_factory (e.g. lambda: query.edit_message_text(...)),
+    retrying on flood control and transient network errors.
+    RetryAfter sleeps for the server-provided retry_after; TimedOut/NetworkError back off
+    exponentially with jitter, capped at max_backoff. 'Message is not modified' is ignored.
+    Other errors, and the last failed attempt, are re-raised to the caller.
+    If chat_id is given, attempts are paced through throttle_chat_edit, so repeated edits
+    to one chat stay at about one per second.
+    """
+    pace = chat_id is not None
+    for attempt in range(max_attempts):
+        try:
+            if pace: await throttle_chat_edit(chat_id)
+            return await coro_factory()
+        except telegram_error.RetryAfter as e:
+            if attempt == max_attempts - 1: raise
+            retry_after = e.retry_after.total_seconds() if isinstance(e.retry_after, timedelta) else e.retry_after
+            logger.warning(f"Rate limit hit on Telegram call (Attempt {attempt+1}/{max_attempts}). Retrying after {retry_after} seconds.")
+            await asyncio.sleep(retry_after)
+            pace = False # The server-imposed wait already spaces out the next attempt
+        except telegram_error.BadRequest as e: # Subclass of NetworkError, never retried
+            if MSG_NOT_MODIFIED in e.message: return None
+            raise
+        except telegram_error.NetworkError as e: # Includes TimedOut
+            if attempt == max_attempts - 1: raise
+            delay = min(max_backoff, 2 ** attempt) + random.uniform(0, 0.5)
+            logger.warning(f"NetworkError on Telegram call (Attempt {attempt+1}/{max_attempts}): {e}. Retrying in {delay:.1f}s.")
+            await asyncio.sleep(delay)
+
+# Fire-and-forget tasks: keep a strong reference until done and log failures instead of losing them
+_background_tasks: set[asyncio.Task] = set()
+
+def _on_background_task_done(task: asyncio.Task):
+    _background_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None: logger.error(f"Background task {task.get_name()} failed: {task.exception()}", exc_info=task.exception())
+
+def spawn_background_task(coro) -> asyncio.Task:
+    """Schedules coro on the running loop without awaiting it. Must be called from the event loop."""
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_on_background_task_done)
+    return task
+
+COALESCE_DELAY_SECONDS = 0.5
+_coalesced_sends: dict[int, asyncio.Task] = {} # chat_id -> send still in its debounce delay
+_inflight_sends: dict[int, asyncio.Task] = {} # chat_id -> latest send past its delay
+
+def coalesce_chat_send(chat_id: int, coro_factory, delay: float = COALESCE_DELAY_SECONDS) -> asyncio.Task:
+    """
+    Debounces outgoing messages per chat: schedules coro_factory() to run after delay
+    seconds, cancelling any send for the same chat that is still in its delay. Bursts
+    (e.g. webhook retries) therefore produce one message carrying the latest state.
+    A send past its delay is never cancelled; the next one waits for it to finish.
+    Must be called from the event loop. Errors are logged, not raised.
+    """
+    pending = _coalesced_sends.get(chat_id)
+    if pending is not None and not pending.done(): pending.cancel()
+
+    async def _send_later():
+        this_task = asyncio.current_task()
+        try: await asyncio.sleep(delay)
+        finally:
+            if _coalesced_sends.get(chat_id) is this_task: del _coalesced_sends[chat_id]
+        # Past the delay: newer calls no longer see this task, so the send below can't be cancelled by them
+        previous = _inflight_sends.get(chat_id)
+        _inflight_sends[chat_id] = this_task
+        try:
+            if previous is not None and not previous.done(): await asyncio.wait((previous,)) # Keep sends to one chat in order
+            await coro_factory()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Coalesced send to chat {chat_id} failed: {e}", exc_info=True)
+        finally:
+            if _inflight_sends.get(chat_id) is this_task: del _inflight_sends[chat_id]
+
+    task = asyncio.create_task(_send_later())
+    _coalesced_sends[chat_id] = task
+    return task
+
 def get_date_range(period_key):
     now = datetime.now(timezone.utc) # Use UTC now
     try:
@@ -1438,23 +1675,36 @@ def fetch_reviews(offset=0, limit=5):
 
 
 # --- API Helpers ---
+def lookup_cached_min_amount(currency_code_lower: str) -> tuple[bool, Decimal | None]:
+    """Returns (hit, min_amount) from min_amount_cache. A hit with None means a recent lookup failed."""
+    entry = min_amount_cache.get(currency_code_lower)
+    if entry is None: return False, None
+    min_amount, fetched_at = entry
+    ttl = CACHE_EXPIRY_SECONDS * 2 if min_amount is not None else MIN_AMOUNT_NEGATIVE_TTL_SECONDS
+    if time.monotonic() - fetched_at < ttl: return True, min_amount
+    return False, None
+
 def get_nowpayments_min_amount(currency_code: str) -> Decimal | None:
     currency_code_lower = currency_code.lower()
-    now = time.time()
-    if currency_code_lower in min_amount_cache:
-        min_amount, timestamp = min_amount_cache[currency_code_lower]
-        if now - timestamp < CACHE_EXPIRY_SECONDS * 2: logger.debug(f"Cache hit for {currency_code_lower} min amount: {min_amount}"); return min_amount
+    hit, min_amount = lookup_cached_min_amount(currency_code_lower)
+    if hit: logger.debug(f"Cache hit for {currency_code_lower} min amount: {min_amount}"); return min_amount
+    min_amount = _fetch_nowpayments_min_amount(currency_code_lower)
+    min_amount_cache[currency_code_lower] = (min_amount, time.monotonic()) # Failures are cached too, briefly
+    return min_amount
+
+def _fetch_nowpayments_min_amount(currency_code_lower: str) -> Decimal | None:
     if not NOWPAYMENTS_API_KEY: logger.error("NOWPayments API key is missing, cannot fetch minimum amount."); return None
     try:
         url = f"{NOWPAYMENTS_API_URL}/v1/min-amount"; params = {'currency_from': currency_code_lower}; headers = {'x-api-key': NOWPAYMENTS_API_KEY}
         logger.debug(f"Fetching min amount for {currency_code_lower} from {url} with params {params}")
         response = requests.get(url, params=params, headers=headers, timeout=10)
-        logger.debug(f"NOWPayments min-amount response status: {response.status_code}, content: {response.text[:200]}")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("NOWPayments min-amount response status: %s, content: %r", response.status_code, response.content[:200])
         response.raise_for_status()
-        data = response.json()
+        data = response.json(parse_float=Decimal)
         min_amount_key = 'min_amount'
         if min_amount_key in data and data[min_amount_key] is not None:
-            min_amount = Decimal(str(data[min_amount_key])); min_amount_cache[currency_code_lower] = (min_amount, now)
+            min_amount = Decimal(data[min_amount_key])
             logger.info(f"Fetched minimum amount for {currency_code_lower}: {min_amount} from NOWPayments.")
             return min_amount
         else: logger.warning(f"Could not find '{min_amount_key}' key or it was null for {currency_code_lower} in NOWPayments response: {data}"); return None
@@ -1587,28 +1837,76 @@ ACTION_RESELLER_DISCOUNT_EDIT = "RESELLER_DISCOUNT_EDIT"
 ACTION_RESELLER_DISCOUNT_DELETE = "RESELLER_DISCOUNT_DELETE"
 # <<< END Define >>>
 
-def log_admin_action(admin_id: int, action: str, target_user_id: int | None = None, reason: str | None = None, amount_change: float | None = None, old_value=None, new_value=None):
-    """Logs an administrative action to the admin_log table."""
+# --- Admin Action Log (batched writes) ---
+ADMIN_LOG_BATCH_MAX = 50 # Rows per INSERT batch
+ADMIN_LOG_FLUSH_SECONDS = 0.1 # How long the writer waits for more rows after the first
+_ADMIN_LOG_INSERT_SQL = """
+    INSERT INTO admin_log (timestamp, admin_id, target_user_id, action, reason, amount_change, old_value, new_value)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+"""
+_admin_log_queue: asyncio.Queue | None = None
+_admin_log_writer: asyncio.Task | None = None
+
+def _write_admin_log_rows(rows: list[tuple]):
     try:
-        with get_db_connection() as conn:
-            c = conn.cursor()
-            c.execute("""
-                INSERT INTO admin_log (timestamp, admin_id, target_user_id, action, reason, amount_change, old_value, new_value)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-            """, (
-                datetime.now(timezone.utc).isoformat(),
-                admin_id,
-                target_user_id,
-                action, # Ensure action string is passed correctly
-                reason,
-                amount_change,
-                str(old_value) if old_value is not None else None,
-                str(new_value) if new_value is not None else None
-            ))
+        with pooled_db_connection() as conn:
+            conn.executemany(_ADMIN_LOG_INSERT_SQL, rows)
             conn.commit()
-            logger.info(f"Admin Action Logged: Admin={admin_id}, Action='{action}', Target={target_user_id}, Reason='{reason}', Amount={amount_change}, Old='{old_value}', New='{new_value}'")
     except sqlite3.Error as e:
-        logger.error(f"Failed to log admin action: {e}", exc_info=True)
+        logger.error(f"Failed to log {len(rows)} admin action(s): {e}", exc_info=True)
+
+async def _admin_log_writer_loop():
+    """Drains _admin_log_queue, writing up to ADMIN_LOG_BATCH_MAX rows per transaction."""
+    loop = asyncio.get_running_loop()
+    while True:
+        rows = [await _admin_log_queue.get()]
+        try:
+            deadline = loop.time() + ADMIN_LOG_FLUSH_SECONDS
+            while len(rows) < ADMIN_LOG_BATCH_MAX and (timeout := deadline - loop.time()) > 0:
+                try: rows.append(await asyncio.wait_for(_admin_log_queue.get(), timeout))
+                except asyncio.TimeoutError: break
+        except asyncio.CancelledError:
+            _write_admin_log_rows(rows); raise # Don't drop rows already taken off the queue
+        await asyncio.to_thread(_write_admin_log_rows, rows)
+
+async def flush_admin_log():
+    """Stops the batch writer and writes anything still queued. Call on shutdown."""
+    global _admin_log_queue, _admin_log_writer
+    if _admin_log_writer is not None:
+        _admin_log_writer.cancel()
+        try: await _admin_log_writer
+        except asyncio.CancelledError: pass
+        _admin_log_writer = None
+    rows = []
+    while _admin_log_queue is not None and not _admin_log_queue.empty(): rows.append(_admin_log_queue.get_nowait())
+    _admin_log_queue = None # Recreated on the next log call (a queue is tied to its event loop)
+    if rows: await asyncio.to_thread(_write_admin_log_rows, rows)
+
+def log_admin_action(admin_id: int, action: str, target_user_id: int | None = None, reason: str | None = None, amount_change: float | None = None, old_value=None, new_value=None):
+    """
+    Logs an administrative action to the admin_log table. On the event loop the row is
+    queued and written in a batch shortly after; elsewhere (threads) it is written immediately.
+    """
+    global _admin_log_queue, _admin_log_writer
+    try:
+        row = (
+            datetime.now(timezone.utc).isoformat(),
+            admin_id,
+            target_user_id,
+            action, # Ensure action string is passed correctly
+            reason,
+            amount_change,
+            str(old_value) if old_value is not None else None,
+            str(new_value) if new_value is not None else None
+        )
+        try: asyncio.get_running_loop(); on_loop = True
+        except RuntimeError: on_loop = False
+        if on_loop:
+            if _admin_log_queue is None: _admin_log_queue = asyncio.Queue()
+            if _admin_log_writer is None or _admin_log_writer.done(): _admin_log_writer = asyncio.create_task(_admin_log_writer_loop())
+            _admin_log_queue.put_nowait(row)
+        else: _write_admin_log_rows([row])
+        logger.info(f"Admin Action Logged: Admin={admin_id}, Action='{action}', Target={target_user_id}, Reason='{reason}', Amount={amount_change}, Old='{old_value}', New='{new_value}'")
     except Exception as e:
         logger.error(f"Unexpected error logging admin action: {e}", exc_info=True)
 